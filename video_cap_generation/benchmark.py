@@ -0,0 +1,155 @@
+"""
+Throughput and latency benchmark of the captioning models on synthetic
+frame features, so loader and model changes can be compared by numbers.
+Every model is built in its own spawned process, which keeps the graphs
+apart and makes the peak RSS that model's own. For each model it reports
+    build_seconds           graph construction and variable initialization
+    train                   steps/sec and examples/sec at BATCH_SIZE
+    predict                 p50/p99 latency per batch, for every PREDICT_BATCH_SIZES
+    peak_rss_mb             peak resident memory of the process
+and writes them with the commit and TensorFlow version to one JSON file.
+
+usage: python3 benchmark.py [output_json] [model_name ...]
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import subprocess
+import queue as queue_module
+import multiprocessing as mp
+import numpy as np
+
+MODELS = ['S2VT_model', 'S2VT_attention_model', 'Effective_attention_model', 'Adversary_S2VT_model']
+OUTPUT_PATH = 'benchmark.json'
+FRAME_STEP = 20
+FRAME_DIM = 4096
+CAPTION_STEP = 45
+VOCAB_SIZE = 3000
+BATCH_SIZE = 100
+PREDICT_BATCH_SIZES = [1, 10, 100]
+WARMUP_STEPS = 3
+TRAIN_STEPS = 20
+PREDICT_RUNS = 20
+SEED = 0
+
+
+def synthetic_batch(rng, batch_size):
+    """Random frames and captions of random length, <bos> ... <eos> then padding."""
+    x = rng.standard_normal((batch_size, FRAME_STEP, FRAME_DIM)).astype(np.float32)
+    y = rng.randint(5, VOCAB_SIZE, size=(batch_size, CAPTION_STEP+1))
+    y_mask = np.zeros((batch_size, CAPTION_STEP+1), dtype=np.float32)
+    lengths = rng.randint(3, CAPTION_STEP+2, size=batch_size)
+    for j, length in enumerate(lengths):
+        y[j, 0] = 4
+        y[j, length-1] = 3
+        y[j, length:] = 0
+        y_mask[j, :length] = 1.0
+    return x, y, y_mask
+
+
+def peak_rss_mb():
+    ## ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def bench_model(name):
+    import tensorflow as tf
+    import model
+
+    model_class = getattr(model, name, None)
+    if model_class is None:
+        return {'error': '{0} is not defined in model.py'.format(name)}
+    rng = np.random.RandomState(SEED)
+    tf.set_random_seed(SEED)
+    result = {}
+
+    start_time = time.time()
+    S2VT = model_class(frame_steps=FRAME_STEP, frame_feat_dim=FRAME_DIM,
+                       caption_steps=CAPTION_STEP, vocab_size=VOCAB_SIZE)
+    S2VT.initialize()
+    result['build_seconds'] = time.time() - start_time
+    result['graph_ops'] = len(tf.get_default_graph().get_operations())
+
+    x, y, y_mask = synthetic_batch(rng, BATCH_SIZE)
+    for _ in range(WARMUP_STEPS):
+        S2VT.train(x, y, y_mask)
+    start_time = time.time()
+    for _ in range(TRAIN_STEPS):
+        S2VT.train(x, y, y_mask)
+    seconds = time.time() - start_time
+    result['train'] = {'batch_size': BATCH_SIZE,
+                       'steps_per_sec': TRAIN_STEPS / seconds,
+                       'examples_per_sec': TRAIN_STEPS * BATCH_SIZE / seconds}
+
+    result['predict'] = {}
+    for batch_size in PREDICT_BATCH_SIZES:
+        x = synthetic_batch(rng, batch_size)[0]
+        for _ in range(WARMUP_STEPS):
+            S2VT.predict(x)
+        latencies = []
+        for _ in range(PREDICT_RUNS):
+            start_time = time.time()
+            S2VT.predict(x)
+            latencies.append(time.time() - start_time)
+        result['predict'][str(batch_size)] = {'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+                                              'p99_ms': 1000 * float(np.percentile(latencies, 99))}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def _bench_in_process(name, queue):
+    try:
+        queue.put(bench_model(name))
+    except Exception as e:
+        queue.put({'error': '{0}: {1}'.format(type(e).__name__, e)})
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(output_path=OUTPUT_PATH, names=MODELS):
+    ## spawn, not fork: every model gets a fresh interpreter and TensorFlow runtime
+    ctx = mp.get_context('spawn')
+    report = {'commit': git_revision(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {'frame_step': FRAME_STEP, 'frame_dim': FRAME_DIM, 'caption_step': CAPTION_STEP,
+                         'vocab_size': VOCAB_SIZE, 'train_steps': TRAIN_STEPS, 'predict_runs': PREDICT_RUNS},
+              'models': {}}
+    for name in names:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_bench_in_process, args=(name, queue))
+        process.start()
+        while True:
+            try:
+                result = queue.get(timeout=5)
+                break
+            except queue_module.Empty:
+                if not process.is_alive():
+                    result = {'error': 'benchmark process exited with code {0}'.format(process.exitcode)}
+                    break
+        process.join()
+        report['models'][name] = result
+        print(name, json.dumps(result))
+
+    try:
+        import tensorflow as tf
+        report['tensorflow'] = tf.__version__
+    except ImportError:
+        report['tensorflow'] = None
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else OUTPUT_PATH, sys.argv[2:] or MODELS)
@@ -1,6 +1,7 @@
 import math
 import operator
 import sys
+from collections import Counter
 from functools import reduce
 
 
@@ -100,3 +101,104 @@ def BLEU(candidate_sentence, reference_sentence):
     score = geometric_mean(precisions) * bp
     return score
 
+
+
+def tokenize(sentence):
+    return sentence.strip().lower().split()
+
+
+def _ngram_counts(ids, n):
+    """Count the n-grams of a sentence given as a list of word ids"""
+    return Counter(zip(*[ids[i:] for i in range(n)]))
+
+
+class ReferenceIndex():
+    """
+    Reference side of corpus BLEU, built once per test set and reused for
+    every checkpoint: the word ids of all references and, per video, the
+    maximum count of each n-gram over its references (the multi-reference
+    clipping limits) plus the reference lengths.
+    references: dict mapping video id to its list of reference sentences.
+    """
+    def __init__(self, references, max_n=4):
+        self.max_n = max_n
+        self.word_ids = {}
+        self.max_counts = {}
+        self.lengths = {}
+        for video_id, refs in references.items():
+            refs = [[self.word_ids.setdefault(w, len(self.word_ids)) for w in tokenize(ref)] for ref in refs]
+            self.lengths[video_id] = [len(ref) for ref in refs]
+            self.max_counts[video_id] = []
+            for n in range(1, max_n + 1):
+                max_ref_counts = Counter()
+                for ref in refs:
+                    max_ref_counts |= _ngram_counts(ref, n)
+                self.max_counts[video_id].append(max_ref_counts)
+
+    def encode(self, sentence):
+        ## a word no reference uses can never match, -1 keeps the index unchanged
+        return [self.word_ids.get(w, -1) for w in tokenize(sentence)]
+
+    def statistics(self, answers):
+        """
+        Sufficient statistics of answers, a list of (video id, sentence):
+        [candidate length, reference length, clipped 1..max_n, total 1..max_n].
+        Statistics of disjoint answer sets add up elementwise, see add_statistics.
+        """
+        clipped = [0] * self.max_n
+        total = [0] * self.max_n
+        c = 0
+        r = 0
+        for video_id, sentence in answers:
+            cand = self.encode(sentence)
+            for n in range(1, self.max_n + 1):
+                clipped[n - 1] += sum((_ngram_counts(cand, n) & self.max_counts[video_id][n - 1]).values())
+                total[n - 1] += max(len(cand) - n + 1, 0)
+            c += len(cand)
+            r += best_length_match(self.lengths[video_id], len(cand))
+        return [c, r] + clipped + total
+
+    def score(self, stats):
+        """BLEU-1..max_n from statistics, returns [BLEU-1, ..., BLEU-max_n]"""
+        c, r = stats[0], stats[1]
+        clipped = stats[2:2 + self.max_n]
+        total = stats[2 + self.max_n:]
+        if c == 0:
+            return [0.] * self.max_n
+        bp = brevity_penalty(c, r)
+        scores = []
+        log_precision = 0.
+        for n in range(self.max_n):
+            if clipped[n] == 0:
+                ## every higher order score is 0 as well
+                scores.extend([0.] * (self.max_n - n))
+                break
+            log_precision += math.log(float(clipped[n]) / total[n])
+            scores.append(bp * math.exp(log_precision / (n + 1)))
+        return scores
+
+    def bleu(self, answers):
+        """
+        Corpus level BLEU-1..max_n of answers, a list of (video id, sentence).
+        Returns [BLEU-1, ..., BLEU-max_n].
+        """
+        return self.score(self.statistics(answers))
+
+
+def add_statistics(a, b):
+    return [x + y for x, y in zip(a, b)]
+
+
+def corpus_bleu(candidates, references, max_n=4):
+    """
+    Corpus level BLEU-1..max_n of a whole test set in one call.
+    candidates: list of sentences, references: list of reference sentence
+    lists, one list per candidate. Every sentence is tokenized once and its
+    n-grams are counted as tuples of integer word ids; candidate counts are
+    clipped by the maximum count over all references of the same candidate.
+    Use a ReferenceIndex directly to score several candidate sets against
+    the same references.
+    Returns [BLEU-1, ..., BLEU-max_n].
+    """
+    index = ReferenceIndex(dict(enumerate(references)), max_n)
+    return index.bleu(list(enumerate(candidates)))
@@ -0,0 +1,116 @@
+"""
+Out-of-process evaluator for the captioning checkpoints, so training never
+stops to evaluate. It watches the {MODEL_FILE_NAME}_para/ directory that
+main.py saves into, restores every new checkpoint into an inference-only
+model and predicts the public test set and the training set. Detokenizing
+and BLEU counting run in a pool of worker processes. For every step it
+writes {MODEL_FILE_NAME}/metrics_<step>.json plus the generated captions.
+main.py's TrainingRunner deletes no checkpoint before its metrics file is
+written, a checkpoint deleted anyway (by hand, or by a run that does not
+wait for this evaluator) is skipped.
+
+usage: python3 evaluate.py [num_workers] [poll_seconds]
+"""
+import os
+import re
+import sys
+import json
+import time
+import multiprocessing as mp
+import tensorflow as tf
+import model
+import input
+import eval
+import main
+import runner
+from vocab import Vocab
+
+CKPT_PATTERN = re.compile(r'^model_(\d+)\.ckpt\.index$')
+POLL_SECONDS = 30
+NUM_WORKERS = 4
+
+## set in every pool worker by _init_worker
+_references = None
+_vocab = None
+
+
+def _init_worker(references, vocab):
+    global _references, _vocab
+    _references = references
+    _vocab = vocab
+
+
+def _score_chunk(chunk):
+    name, video_ids, words = chunk
+    sentences = _vocab.decode(words)
+    answers = list(zip(video_ids, sentences))
+    return name, answers, _references[name].statistics(answers)
+
+
+def new_checkpoints(para_path, output_path):
+    steps = []
+    for filename in os.listdir(para_path):
+        match = CKPT_PATTERN.match(filename)
+        if match is None:
+            continue
+        step = int(match.group(1))
+        if not os.path.exists(os.path.join(output_path, runner.METRICS_FILE.format(step))):
+            steps.append(step)
+    return sorted(steps)
+
+
+def evaluate(S2VT, eval_sets, pool, global_step, output_path):
+    start_time = time.time()
+    ## prediction stays in this process, it owns the session
+    chunks = []
+    for name, batches, _ in eval_sets:
+        for x, video_ids, _ in batches:
+            chunks.append((name, video_ids, S2VT.predict(x)[0]))
+
+    answers = dict((name, []) for name, _, _ in eval_sets)
+    stats = dict((name, None) for name, _, _ in eval_sets)
+    for name, chunk_answers, chunk_stats in pool.imap(_score_chunk, chunks):
+        answers[name].extend(chunk_answers)
+        stats[name] = chunk_stats if stats[name] is None else eval.add_statistics(stats[name], chunk_stats)
+
+    metrics = {'step': global_step}
+    for name, _, references in eval_sets:
+        metrics[name] = {'bleu': references.score(stats[name])}
+        print('{0} BLEU-1..4 of step {1}: {2}'.format(name, global_step,
+                                                     ' '.join('{0:.4f}'.format(score) for score in metrics[name]['bleu'])))
+        json.dump([{'caption': cap, 'id:': vid} for vid, cap in answers[name]],
+                  open(os.path.join(output_path, name + '_result_' + str(global_step) + '.json'), 'w'))
+    metrics['eval_seconds'] = time.time() - start_time
+    json.dump(metrics, open(os.path.join(output_path, runner.METRICS_FILE.format(global_step)), 'w'))
+
+
+def main_loop(num_workers=NUM_WORKERS, poll_seconds=POLL_SECONDS):
+    para_path = main.MODEL_FILE_NAME + '_para'
+    output_path = main.MODEL_FILE_NAME
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    vocab = Vocab.load(main.VOCAB_PATH, main.DICT_REV_PATH)
+    sampler = input.FrameSampler(main.FRAME_STEP, main.FRAME_SAMPLING, main.FRAME_STRIDE)
+    eval_sets = main.load_eval_sets(sampler)
+    references = dict((name, refs) for name, _, refs in eval_sets)
+    pool = mp.Pool(num_workers, initializer=_init_worker, initargs=(references, vocab))
+
+    S2VT = model.Effective_attention_model(frame_feat_dim=main.FEATURE_DIM, caption_steps=main.CAPTION_STEP,
+                                           training=False)
+    print('watching {0} ...'.format(para_path))
+    while True:
+        steps = new_checkpoints(para_path, output_path) if os.path.exists(para_path) else []
+        for global_step in steps:
+            try:
+                S2VT.loadModel(os.path.join(para_path, runner.CKPT_FILE.format(global_step)))
+            except tf.errors.NotFoundError:
+                print('checkpoint of step {0} was deleted before it was evaluated, skipped'.format(global_step))
+                continue
+            evaluate(S2VT, eval_sets, pool, global_step, output_path)
+        if not steps:
+            time.sleep(poll_seconds)
+
+
+if __name__ == '__main__':
+    main_loop(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,41 @@
+"""
+Frozen inference graph of Effective_attention_model.
+
+`export_frozen` restores a training checkpoint into an inference-only model,
+turns its variables into constants and keeps only the ops the decoders need,
+so no optimizer slot, loss or scheduled sampling op is left.
+`model.Frozen_inference_model` starts from that single file without
+building the model or restoring a checkpoint, and predicts like the model
+it was exported from.
+
+>>> python3 export.py model_30000.ckpt frozen_model.pb
+>>> S2VT = model.Frozen_inference_model('frozen_model.pb')
+>>> S2VT.predict_beam(x, length_penalty=0.6)
+
+usage: python3 export.py model_path output_path [beam_width]
+"""
+import sys
+import tensorflow as tf
+import model
+import test_main
+
+OUTPUT_NODES = ['greedy_result', 'beam_result']
+
+
+def export_frozen(model_path, output_path, beam_width=test_main.BEAM_WIDTH):
+    with tf.Graph().as_default():
+        S2VT = model.Effective_attention_model(frame_feat_dim=test_main.FEATURE_DIM, caption_steps=test_main.CAPTION_STEP,
+                                               beam_width=beam_width, training=False)
+        S2VT.loadModel(model_path)
+        outputs = OUTPUT_NODES if beam_width > 0 else OUTPUT_NODES[:1]
+        ## keeps only what the outputs depend on, with every variable folded into a constant
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            S2VT.sess, S2VT.sess.graph.as_graph_def(), outputs)
+        S2VT.sess.close()
+    with open(output_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('{0} ops written to {1}'.format(len(graph_def.node), output_path))
+
+
+if __name__ == '__main__':
+    export_frozen(sys.argv[1], sys.argv[2], *[int(arg) for arg in sys.argv[3:4]])
@@ -2,14 +2,108 @@ import numpy as np
 import multiprocessing as mp
 import random
 import os
+import json
+import queue
+import threading
+import traceback
+
+PACK_FEAT_FILE = 'feat.npy'
+PACK_INDEX_FILE = 'index.json'
+## reduced copy of PACK_FEAT_FILE written by util.reduce_features, and its projection
+PACK_REDUCED_FEAT_FILE = 'feat_{0}.npy'
+PACK_PROJECTION_FILE = 'projection_{0}.npz'
+
+SAMPLING_STRATEGIES = ('stride', 'uniform', 'random')
+
+
+class FrameSampler():
+    """
+    Picks `frame_step` frames out of a clip and writes them into a batch slot.
+      stride:  every `stride`-th frame from the first one
+      uniform: `frame_step` frames spread evenly over the whole clip
+      random:  like stride, but from a random start frame when augmenting
+    The same sampler is shared by training and testing loaders so both see
+    the same frames; `augment` is only set by the training loader.
+    """
+    def __init__(self, frame_step=20, strategy='stride', stride=4):
+        if strategy not in SAMPLING_STRATEGIES:
+            raise ValueError('unknown frame sampling strategy: {0}'.format(strategy))
+        self.frame_step = frame_step
+        self.strategy = strategy
+        self.stride = stride
+
+    def indices(self, n_frames):
+        if self.strategy == 'uniform':
+            return np.linspace(0, n_frames - 1, self.frame_step).astype(np.intp)
+        return np.arange(self.frame_step) * self.stride
+
+    def sample_into(self, x, out, augment=False, rng=None):
+        n_frames = x.shape[0]
+        span = self.stride * (self.frame_step - 1) + 1
+        if self.strategy != 'uniform' and n_frames >= span:
+            start = 0
+            if self.strategy == 'random' and augment:
+                start = (rng if rng is not None else random).randint(0, n_frames - span)
+            ## strided view, copied once straight into the batch slot
+            out[...] = x[start:start+span:self.stride]
+        elif x.dtype == out.dtype:
+            ## mode='clip' repeats the last frame of clips that are too short
+            np.take(x, self.indices(n_frames), axis=0, out=out, mode='clip')
+        else:
+            out[...] = x[np.minimum(self.indices(n_frames), n_frames - 1)]
+        return out
+
+
+def pack_feat_path(pack_path, reduced_dim=None):
+    """Features of a pack, the `reduced_dim`-d ones if it is set"""
+    if reduced_dim is None:
+        return os.path.join(pack_path, PACK_FEAT_FILE)
+    return os.path.join(pack_path, PACK_REDUCED_FEAT_FILE.format(reduced_dim))
+
+
+class FeatureStore():
+    """
+    Frame features of every video, looked up by video id.
+    With `pack_path` set, features are sliced out of the memory-mapped array
+    written by `util.pack_features`; otherwise one `<video_id>.npy` is read
+    from `data_path` per lookup. With `reduced_dim` as well, the
+    `reduced_dim`-d features of `util.reduce_features` are read instead.
+    """
+    def __init__(self, data_path, pack_path=None, reduced_dim=None):
+        self.data_path = data_path
+        self.pack_path = pack_path
+        self.feat = None
+        self.index = None
+        if reduced_dim is not None and pack_path is None:
+            raise ValueError('reduced features are only stored in a packed feature cache')
+        if pack_path is not None:
+            self.feat = np.load(pack_feat_path(pack_path, reduced_dim), mmap_mode='r')
+            with open(os.path.join(pack_path, PACK_INDEX_FILE)) as f:
+                self.index = json.load(f)
+
+    @property
+    def packed(self):
+        return self.feat is not None
+
+    def __getitem__(self, video_id):
+        if self.packed:
+            ## a view into the page cache, no copy until the batch is filled
+            offset, length = self.index[video_id]
+            return self.feat[offset:offset+length]
+        return np.load(os.path.join(self.data_path, video_id + '.npy'))
+
 
 class DataLoader():
-    def __init__(self, input_json, data_path='data/training_data/feat' ,frame_step=20, frame_dim=4096, caption_step=45 ,vocab_size=3000):
+    def __init__(self, input_json, data_path='data/training_data/feat' ,frame_step=20, frame_dim=4096, caption_step=45 ,vocab_size=3000, pack_path=None, sampler=None, buckets=None, seed=None, reduced_dim=None):
         self.vocab_size = vocab_size
         self.data_path = data_path
+        self.features = FeatureStore(data_path, pack_path, reduced_dim)
+        self.sampler = sampler if sampler is not None else FrameSampler(frame_step)
         self.frame_step = frame_step
         self.frame_dim = frame_dim
         self.caption_step = caption_step
+        ## decoder lengths a batch may be padded to, the longest is always caption_step
+        self.buckets = sorted(set(b for b in (buckets or []) if b < caption_step) | {caption_step})
         
         self.video_names = []
         self.cap_sentences = []
@@ -17,57 +111,266 @@ class DataLoader():
             for sentence in video['caption']:
                 self.video_names.append(video['id'])
                 self.cap_sentences.append(sentence)
-        self.shuffle()
+        ## with a seed the sample order, and so every batch plan, is the same in every run
+        self.shuffle(seed)
 
-    def shuffle(self):
+    def shuffle(self, seed=None):
         z = list(zip(self.video_names, self.cap_sentences))
-        random.shuffle(z)
+        (random.Random(seed) if seed is not None else random).shuffle(z)
         self.video_names, self.cap_sentences = zip(*z)
         
-    def batch_gen(self, batch_size):
-        QUEUE_END = '__QUEUE_END105834569xx'
-        
-        def raw2vec(caption_step, q):
-            
-            for i, filename in enumerate(self.video_names):
-                filepath = os.path.join(self.data_path, filename + '.npy')
-                x = np.load(filepath)                
-                y = np.array(self.cap_sentences[i]).astype(np.int32)
-                q.put((x,y))
-            q.put(QUEUE_END)
-            q.close()
-            
-        q = mp.Queue(maxsize=200)
-        
-        p = mp.Process(target=raw2vec, args=(self.caption_step, q))
-        p.daemon = True
-        p.start()
-        
-        x_batch = np.zeros((batch_size, self.frame_step, self.frame_dim), dtype=np.float32)
-        y_batch = np.zeros((batch_size, self.caption_step+1), dtype=np.int32)
-        y_mask = np.zeros((batch_size, self.caption_step+1), dtype=np.int32)
-        
-        for i in range(0, len(self.video_names), batch_size):
-            for j in range(batch_size):
-                vec = q.get()
-                
-                if vec == QUEUE_END:
-                    x_batch = np.delete(x_batch, range(j, batch_size), axis=0)
-                    y_batch = np.delete(y_batch, range(j, batch_size), axis=0)
-                    y_mask = np.delete(y_mask, range(j, batch_size), axis=0)
+    def bucket_of(self, caption):
+        ## a caption of n tokens is decoded in n-1 steps
+        steps = len(caption) - 1
+        for bucket in self.buckets:
+            if steps <= bucket:
+                return bucket
+        return self.caption_step
+
+    def batch_plan(self, batch_size, order=None, rng=None):
+        """
+        Split the samples `order` into batches of (indices, steps), where every
+        caption of a batch fits in `steps` decoder steps. Without extra buckets
+        this is just `order` cut into consecutive batches.
+        """
+        if order is None:
+            order = np.arange(len(self.video_names))
+        if len(self.buckets) == 1:
+            return [(order[i:i+batch_size], self.caption_step) for i in range(0, len(order), batch_size)]
+
+        bucket_members = dict((bucket, []) for bucket in self.buckets)
+        for k in order:
+            bucket_members[self.bucket_of(self.cap_sentences[k])].append(k)
+        plan = []
+        for bucket, members in bucket_members.items():
+            members = np.asarray(members, dtype=np.intp)
+            plan.extend((members[i:i+batch_size], bucket) for i in range(0, len(members), batch_size))
+        ## mix buckets so consecutive steps do not all share one length
+        (rng if rng is not None else np.random).shuffle(plan)
+        return plan
+
+    def epoch_plan(self, batch_size, seed, epoch):
+        """The batch plan of `epoch`, drawn from a generator seeded by (seed, epoch)."""
+        rng = np.random.RandomState(seed + epoch)
+        order = rng.permutation(len(self.video_names))
+        return self.batch_plan(batch_size, order, rng)
+
+    def fill_batch(self, indices, x_batch, y_batch, y_mask, augment=True, rng=None):
+        """Write samples `indices` into the given batch arrays, return how many were written."""
+        ## worker slots and ring buffers are reused, a short caption must not keep the previous tokens
+        y_batch[...] = 0
+        y_mask[...] = 0
+        for j, k in enumerate(indices):
+            self.sampler.sample_into(self.features[self.video_names[k]], x_batch[j], augment=augment, rng=rng)
+            y = self.cap_sentences[k]
+            y_batch[j, :len(y)] = y
+            y_mask[j, :len(y)] = 1
+        return len(indices)
+
+    def batch_gen(self, batch_size, num_workers=0, seed=0, epoch=0, num_buffers=2, start=0):
+        """
+        Yield the batches of `epoch`, skipping its first `start` ones, so an
+        interrupted epoch resumes where it stopped. Both paths follow
+        `epoch_plan`, the batches do not depend on num_workers.
+        """
+        if num_workers > 0:
+            yield from BatchPipeline(self, batch_size, num_workers, seed=seed).batch_gen(epoch, start)
+            return
+
+        ring = BatchRing(self, batch_size, num_buffers, plan=self.epoch_plan(batch_size, seed, epoch)[start:],
+                         seed=seed, epoch=epoch, start=start)
+        try:
+            for slot, x_batch, y_batch, y_mask in ring:
+                yield x_batch, y_batch, y_mask
+                ## the consumer is done with this batch once it asks for the next
+                ring.release(slot)
+        finally:
+            ring.close()
+
+
+def batch_rng(seed, epoch, b):
+    ## seeded per batch so augmentation depends neither on worker scheduling nor on
+    ## num_workers; its own generator, so filler threads leave the global `random` alone
+    return random.Random('{0}:{1}:{2}'.format(seed, epoch, b))
+
+
+class BatchRing():
+    """
+    `num_buffers` preallocated batches filled in `plan` order (see
+    `DataLoader.batch_plan`) by a background thread. `get()` returns (slot, x_batch, y_batch, y_mask) for the next batch, or None
+    once the epoch is over; it raises whatever the filler raised. The consumer hands the slot back with `release(slot)`
+    when it is done with it; only then may the filler clear and reuse it.
+    With num_buffers=2 this is a double buffer: the next batch fills while the
+    model trains on the current one.
+    With a `seed`, batch `start + i` of the plan is augmented from
+    `batch_rng(seed, epoch, start + i)`, as BatchPipeline does.
+    """
+    def __init__(self, loader, batch_size, num_buffers=2, plan=None, seed=None, epoch=0, start=0):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.x = np.zeros((num_buffers, batch_size, loader.frame_step, loader.frame_dim), dtype=np.float32)
+        self.y = np.zeros((num_buffers, batch_size, loader.caption_step+1), dtype=np.int32)
+        self.mask = np.zeros((num_buffers, batch_size, loader.caption_step+1), dtype=np.int32)
+
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(num_buffers):
+            self.free.put(slot)
+        if plan is None:
+            plan = loader.batch_plan(batch_size)
+        self.seed = seed
+        self.epoch = epoch
+        self.start = start
+        self.thread = threading.Thread(target=self._fill, args=(plan,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self, plan):
+        try:
+            for b, (indices, steps) in enumerate(plan, self.start):
+                slot = self.free.get()
+                if slot is None:
+                    return
+                rng = batch_rng(self.seed, self.epoch, b) if self.seed is not None else None
+                count = self.loader.fill_batch(indices, self.x[slot], self.y[slot], self.mask[slot], rng=rng)
+                self.ready.put((slot, count, steps))
+        except Exception as e:
+            ## the consumer waits on `ready`, hand it the error instead of leaving it blocked
+            self.ready.put(e)
+            return
+        self.ready.put(None)
+
+    def get(self):
+        item = self.ready.get()
+        if item is None:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        slot, count, steps = item
+        return slot, self.x[slot, :count], self.y[slot, :count, :steps+1], self.mask[slot, :count, :steps+1]
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def close(self):
+        ## wakes up a filler waiting for a free slot
+        self.free.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+
+def _batch_worker(pipeline, worker_id, plan, epoch, start, free, ready):
+    try:
+        x_slots, y_slots, mask_slots = pipeline.slots()
+        ## first batch of this worker at or after `start`
+        first = start + (worker_id - start) % pipeline.num_workers
+        for b in range(first, len(plan), pipeline.num_workers):
+            slot = free.get()
+            count = pipeline.loader.fill_batch(plan[b][0],
+                                               x_slots[worker_id, slot],
+                                               y_slots[worker_id, slot],
+                                               mask_slots[worker_id, slot],
+                                               rng=batch_rng(pipeline.seed, epoch, b))
+            ready.put((slot, count))
+    except Exception:
+        ## the consumer waits on `ready`, it raises this instead of blocking forever;
+        ## a RuntimeError of the formatted traceback always pickles
+        ready.put(RuntimeError('batch worker {0} failed:\n{1}'.format(worker_id, traceback.format_exc())))
+
+
+class BatchPipeline():
+    """
+    Builds whole training batches in `num_workers` processes, straight into
+    shared memory slots, so no sample is pickled through a pipe.
+    Batch b of an epoch is always built by worker b % num_workers into one of
+    that worker's own `slots_per_worker` slots, and the batch plan of an
+    epoch is drawn from a generator seeded by (seed, epoch). The yielded
+    batches are therefore the same for a given seed however the workers are
+    scheduled.
+    Yielded arrays are views into a slot, valid until the next batch is requested.
+    """
+    def __init__(self, loader, batch_size, num_workers=4, slots_per_worker=2, seed=0):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.slots_per_worker = slots_per_worker
+        self.seed = seed
+
+        slot_shape = (num_workers, slots_per_worker, batch_size)
+        self.x_shape = slot_shape + (loader.frame_step, loader.frame_dim)
+        self.y_shape = slot_shape + (loader.caption_step+1,)
+        self.x_shared = mp.RawArray('f', int(np.prod(self.x_shape)))
+        self.y_shared = mp.RawArray('i', int(np.prod(self.y_shape)))
+        self.mask_shared = mp.RawArray('i', int(np.prod(self.y_shape)))
+
+    def slots(self):
+        x_slots = np.frombuffer(self.x_shared, dtype=np.float32).reshape(self.x_shape)
+        y_slots = np.frombuffer(self.y_shared, dtype=np.int32).reshape(self.y_shape)
+        mask_slots = np.frombuffer(self.mask_shared, dtype=np.int32).reshape(self.y_shape)
+        return x_slots, y_slots, mask_slots
+
+    def epoch_plan(self, epoch):
+        return self.loader.epoch_plan(self.batch_size, self.seed, epoch)
+
+    @staticmethod
+    def _get(ready, worker):
+        ## a worker killed without raising (out of memory, a signal) puts nothing on `ready`
+        while True:
+            try:
+                return ready.get(timeout=1.0)
+            except queue.Empty:
+                if not worker.is_alive():
                     break
-                x, y = vec
-                x = np.asarray([x[k*2,:]for k in range(self.frame_step)])
-                x_batch[j, ...] = x
-                y_batch[j,:len(y)] = y
-                y_mask[j, :len(y)] = 1
-                
-            yield x_batch, y_batch,y_mask
+        ## what it put before exiting may still be in the pipe
+        try:
+            return ready.get(timeout=1.0)
+        except queue.Empty:
+            raise RuntimeError('batch worker exited with code {0}'.format(worker.exitcode))
+
+    def batch_gen(self, epoch=0, start=0):
+        plan = self.epoch_plan(epoch)
+        x_slots, y_slots, mask_slots = self.slots()
+        free = [mp.Queue() for _ in range(self.num_workers)]
+        ready = [mp.Queue() for _ in range(self.num_workers)]
+        workers = []
+        for w in range(self.num_workers):
+            for slot in range(self.slots_per_worker):
+                free[w].put(slot)
+            p = mp.Process(target=_batch_worker, args=(self, w, plan, epoch, start, free[w], ready[w]))
+            p.daemon = True
+            p.start()
+            workers.append(p)
+
+        try:
+            prev = None
+            for b in range(start, len(plan)):
+                steps = plan[b][1]
+                ## the consumer is done with the previous batch once it asks for the next
+                if prev is not None:
+                    free[prev[0]].put(prev[1])
+                w = b % self.num_workers
+                item = self._get(ready[w], workers[w])
+                if isinstance(item, Exception):
+                    raise item
+                slot, count = item
+                prev = (w, slot)
+                yield x_slots[w, slot, :count], y_slots[w, slot, :count, :steps+1], mask_slots[w, slot, :count, :steps+1]
+        finally:
+            for p in workers:
+                p.terminate()
+
 
 class TestDataLoader():
-    def __init__(self, input_json, data_path='data/testing_data/feat', frame_step=20, frame_dim=4096, caption_step=45, vocab_size=3000, shuffle=True):
+    def __init__(self, input_json, data_path='data/testing_data/feat', frame_step=20, frame_dim=4096, caption_step=45, vocab_size=3000, shuffle=True, pack_path=None, sampler=None, reduced_dim=None):
         self.vocab_size = vocab_size
         self.data_path = data_path
+        self.features = FeatureStore(data_path, pack_path, reduced_dim)
+        self.sampler = sampler if sampler is not None else FrameSampler(frame_step)
         self.frame_step = frame_step
         self.frame_dim = frame_dim
         self.caption_step = caption_step
@@ -90,18 +393,18 @@ class TestDataLoader():
                     end = i + j
                     break
                 filename = self.video_names[i + j]
-                filepath = os.path.join(self.data_path, filename + '.npy')
-                x = np.load(filepath) 
-                x = np.asarray([x[k*4,:]for k in range(self.frame_step)])
-                x_batch[j, ...] = x
+                x = self.features[filename]
+                self.sampler.sample_into(x, x_batch[j])
             ret.append((x_batch, self.video_names[i:end], self.captions[i:end]))
         return ret
 
 
 class TestPrivateDataLoader():
-    def __init__(self, id_path, data_path, frame_step=20, frame_dim=4096, caption_step=45, vocab_size=3000, shuffle=True):
+    def __init__(self, id_path, data_path, frame_step=20, frame_dim=4096, caption_step=45, vocab_size=3000, shuffle=True, pack_path=None, sampler=None, reduced_dim=None):
         self.vocab_size = vocab_size
         self.data_path = data_path
+        self.features = FeatureStore(data_path, pack_path, reduced_dim)
+        self.sampler = sampler if sampler is not None else FrameSampler(frame_step)
         self.frame_step = frame_step
         self.frame_dim = frame_dim
         self.caption_step = caption_step
@@ -114,6 +417,51 @@ class TestPrivateDataLoader():
         for id in ids:
             self.video_names.append(id)
 
+    def batch_gen(self, batch_size, num_buffers=2):
+        """
+        Stream (x_batch, video_ids) through `num_buffers` preallocated batches
+        filled by a background thread, so memory does not grow with the number
+        of videos. A yielded x_batch is reused once the next batch is asked for.
+        """
+        x = np.zeros((num_buffers, batch_size, self.frame_step, self.frame_dim), dtype=np.float32)
+        free = queue.Queue()
+        ready = queue.Queue()
+        for slot in range(num_buffers):
+            free.put(slot)
+
+        def fill():
+            try:
+                for i in range(0, len(self.video_names), batch_size):
+                    slot = free.get()
+                    if slot is None:
+                        return
+                    video_ids = self.video_names[i:i+batch_size]
+                    for j, filename in enumerate(video_ids):
+                        self.sampler.sample_into(self.features[filename], x[slot, j])
+                    ready.put((slot, video_ids))
+            except Exception as e:
+                ## as in BatchRing, the consumer re-raises it instead of blocking
+                ready.put(e)
+                return
+            ready.put(None)
+
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                slot, video_ids = item
+                yield x[slot, :len(video_ids)], video_ids
+                free.put(slot)
+        finally:
+            ## wakes up a filler waiting for a free slot when the consumer stops early
+            free.put(None)
+
     def get_data(self, batch_size):
         ret = []
 
@@ -127,10 +475,8 @@ class TestPrivateDataLoader():
                     end = i + j
                     break
                 filename = self.video_names[i + j]
-                filepath = os.path.join(self.data_path, filename + '.npy')
-                x = np.load(filepath)
-                x = np.asarray([x[k * 4, :]for k in range(self.frame_step)])
-                x_batch[j, ...] = x
+                x = self.features[filename]
+                self.sampler.sample_into(x, x_batch[j])
             ret.append(
                 (x_batch, self.video_names[i:end]))
         return ret
@@ -1,11 +1,13 @@
+import os
 import sys
 import json
-import numpy as np
 import model
 import util
 import input
 import eval
 import time
+from vocab import Vocab
+from runner import TrainingRunner
 
 VOCAB_SIZE = 3000
 FRAME_STEP = 20
@@ -14,104 +16,166 @@ BATCH_SIZE = 100
 CAPTION_STEP = 45
 EPOCH = 1000
 SCHEDULED_SAMPLING_CONVERGE = 5000
+## how the ground truth feeding probability decays with global_step, see model.scheduled_sampling_prob
+SAMPLING_SCHEDULE = 'inverse_sigmoid'
 MODEL_FILE_NAME = 'result_schedule'
+## vocab.npy is written by util.build_word2idx_dict, without it the vocabulary is built from dict_rev.json
+VOCAB_PATH = 'data/vocab.npy'
+DICT_REV_PATH = 'data/dict_rev.json'
+FRAME_SAMPLING = 'stride'
+FRAME_STRIDE = 4
+NUM_WORKERS = 4
+SEED = 0
+BUCKETS = [12, 16, 24]
+## 'float16' or 'bfloat16' runs the matmuls in lower precision, variables stay float32
+PRECISION = 'float32'
+XLA = False
+## None lets TensorFlow place the embedding lookup instead of pinning it to the CPU
+EMBEDDING_DEVICE = '/cpu:0'
+LOG_DEVICE_PLACEMENT = False
+## print where the loop spends its time every TIMING_STEPS steps
+TIMING_STEPS = 100
+## save a Chrome trace of one training step every TRACE_STEPS steps, 0 never
+TRACE_STEPS = 0
+## checkpoints kept on disk, the newest ones plus one every KEEP_CHECKPOINT_HOURS. With
+## EVAL_IN_PROCESS False an older one is only deleted once evaluate.py has scored it, which
+## takes up to evaluate.POLL_SECONDS plus its evaluation time per checkpoint; checkpoints
+## accumulate beyond MAX_CHECKPOINTS while evaluate.py is behind or not running
+MAX_CHECKPOINTS = 10
+KEEP_CHECKPOINT_HOURS = 6
+## False leaves scoring to evaluate.py, which watches MODEL_FILE_NAME_para/
+EVAL_IN_PROCESS = False
+## packed feature caches of util.pack_features, None reads one npy per video
+TRAIN_PACK_PATH = None
+TEST_PACK_PATH = None
+## read the REDUCED_DIM-d features of util.reduce_features from the packs, None the full FRAME_DIM
+REDUCED_DIM = None
+FEATURE_DIM = REDUCED_DIM or FRAME_DIM
 
 
 train_npy_path = 'data/training_data/feat'
 
-def trim(sen):
-    if 3 in sen:
-        return sen[:sen.index(3)]
-    else:
-        return sen
-
-def test(model, test_data, dict_rev, global_step, output_path= MODEL_FILE_NAME+'/' , train_test='test'):
+def test(model, test_data, references, vocab, global_step, output_path= MODEL_FILE_NAME+'/' , train_test='test'):
     answers = []
-    score = 0
-    for x, video_ids, captions in test_data:
+    for x, video_ids, _ in test_data:
         result = model.predict(x)
         ## remove eos
-        sentences = [' '.join([dict_rev[str(word)] for word in trim(sen.tolist())]) for sen in result[0]]
+        sentences = vocab.decode(result[0])
         answers.extend(list(zip(video_ids, sentences)))
-        for index, answer in enumerate(sentences):
-            score += np.mean(np.array([eval.BLEU(answer, cap) for cap in captions[index]]))
-    print('{0} BLEU score of step {1}: {2}'.format(train_test, global_step, score/len(answers)))
+    scores = references.bleu(answers)
+    print('{0} BLEU-1..4 of step {1}: {2}'.format(train_test, global_step,
+                                                 ' '.join('{0:.4f}'.format(score) for score in scores)))
     json.dump([{'caption': cap, 'id:': vid} for vid, cap in answers],
               open(output_path + train_test + '_result_' +str(global_step) + '.json', 'w'))
         
 
+def load_eval_sets(sampler):
+    """
+    Load the public test set and the training set for evaluation.
+    Returns [(name, batches, references)], the reference n-grams of each set
+    are counted once here and reused at every evaluation.
+    """
+    test_label = json.load(open('data/testing_public_label.json'))
+    train_label = json.load(open('data/training_label.json'))
+    test_data_loader = input.TestDataLoader(test_label,
+                                        data_path='data/testing_data/feat',
+                                        frame_step=FRAME_STEP,
+                                        frame_dim=FEATURE_DIM,
+                                        caption_step=CAPTION_STEP,
+                                        vocab_size=VOCAB_SIZE,
+                                        shuffle=False,
+                                        sampler=sampler,
+                                        pack_path=TEST_PACK_PATH,
+                                        reduced_dim=REDUCED_DIM
+                                        )
+    train_test_data_loader = input.TestDataLoader(train_label,
+                                                  data_path = train_npy_path,
+                                                  frame_step = FRAME_STEP,
+                                                  frame_dim = FEATURE_DIM,
+                                                  caption_step=CAPTION_STEP,
+                                                  vocab_size=VOCAB_SIZE,
+                                                  shuffle=False,
+                                                  sampler=sampler,
+                                                  pack_path=TRAIN_PACK_PATH,
+                                                  reduced_dim=REDUCED_DIM)
+    eval_sets = []
+    for name, loader in [('test', test_data_loader), ('train', train_test_data_loader)]:
+        references = eval.ReferenceIndex(dict(zip(loader.video_names, loader.captions)))
+        eval_sets.append((name, loader.get_data(BATCH_SIZE), references))
+    return eval_sets
+
+
 
 def main():
 
 
     print ("building model...")
-    S2VT = model.Effective_attention_model(caption_steps=CAPTION_STEP)
-    # S2VT.loadModel('result_schedule_para/model_10000.ckpt')
-    # print ("loading sucessfully")
-    # S2VT.initialize()
-    # print ("building model successfully...")
+    S2VT = model.Effective_attention_model(frame_feat_dim=FEATURE_DIM, caption_steps=CAPTION_STEP, buckets=BUCKETS,
+                                           precision=PRECISION, xla=XLA,
+                                           embedding_device=EMBEDDING_DEVICE,
+                                           log_device_placement=LOG_DEVICE_PLACEMENT,
+                                           sampling_schedule=SAMPLING_SCHEDULE,
+                                           sampling_converge=SCHEDULED_SAMPLING_CONVERGE)
+    S2VT.initialize()
+    print ("building model successfully...")
     
-    # d_word2idx = json.load(open('data/dict.json', 'r'))
-    # d_idx2word = json.load(open('data/dict_rev.json', 'r'))
-    # tr_in_idx = util.get_tr_in_idx(trainlable_json='data/training_label.json', dict_path='data/dict.json')
-    # test_label = json.load(open('data/testing_public_label.json'))
+    vocab = Vocab.load(VOCAB_PATH, DICT_REV_PATH)
+    tr_in_idx = util.get_tr_in_idx(trainlable_json='data/training_label.json', dict_path='data/dict.json')
+    sampler = input.FrameSampler(FRAME_STEP, FRAME_SAMPLING, FRAME_STRIDE)
 
-    # # dataLoader = input.DataLoader(tr_in_idx,
-    # #                               data_path='data/training_data/feat',
-    # #                               frame_step=FRAME_STEP,
-    # #                               frame_dim=FRAME_DIM,
-    # #                               caption_step=CAPTION_STEP,
-    # #                               vocab_size=VOCAB_SIZE
-    # #                              )
-    # data = util.Data(
-    #     'data/training_data/feat',
-    #     json.load(open('data/training_label.json')),
-    #     d_word2idx,
-    #     d_idx2word,
-    #     BATCH_SIZE)
-    # test_data_loader = input.TestDataLoader(test_label,
-    #                                     data_path='data/testing_data/feat',
-    #                                     frame_step=FRAME_STEP,
-    #                                     frame_dim=FRAME_DIM,
-    #                                     caption_step=CAPTION_STEP,
-    #                                     vocab_size=VOCAB_SIZE,
-    #                                     shuffle=False
-    #                                     )
-    # train_label = json.load(open('data/training_label.json'))
-    # train_test_data_loader = input.TestDataLoader(train_label,
-    #                                               data_path = 'data/training_data/feat',
-    #                                               frame_step = FRAME_STEP,
-    #                                               frame_dim = FRAME_DIM,
-    #                                               caption_step=CAPTION_STEP,
-    #                                               vocab_size=VOCAB_SIZE,
-    #                                               shuffle=False)
-    # test_batch = test_data_loader.get_data(BATCH_SIZE)
-    # train_test_batch = train_test_data_loader.get_data(BATCH_SIZE)
+    dataLoader = input.DataLoader(tr_in_idx,
+                                  data_path=train_npy_path,
+                                  frame_step=FRAME_STEP,
+                                  frame_dim=FEATURE_DIM,
+                                  caption_step=CAPTION_STEP,
+                                  vocab_size=VOCAB_SIZE,
+                                  sampler=sampler,
+                                  buckets=BUCKETS,
+                                  seed=SEED,
+                                  pack_path=TRAIN_PACK_PATH,
+                                  reduced_dim=REDUCED_DIM
+                                 )
+    if EVAL_IN_PROCESS:
+        eval_sets = load_eval_sets(sampler)
 
-    # global_step = 0
-    # epoch_count = 1
-    # epoch_size = len(data)
-    # print (epoch_size)
-    # loader = data.loader()
-    # print ("training start....")
-    # for i in range(int(len(data) * EPOCH / BATCH_SIZE)):  
-        
-    #     frames, captions, target_weights = next(loader)
-    #     start_time = time.time()
-    #     cost = S2VT.train(
-    #         frames, captions, target_weights, scheduled_sampling_prob=i / SCHEDULED_SAMPLING_CONVERGE)
-    #     global_step += 1
-    #     finish_time = time.time()
-    #     #print ('each step time cost: {0}'.format(finish_time-start_time))
-    #     if global_step % 100 == 0:
-    #         print('global_step {0} cost: {1}'.format(global_step, cost))
-    #     if global_step % 2000 == 0:
-    #         test(S2VT, test_batch, d_idx2word, global_step,train_test = 'test')
-    #         test(S2VT, train_test_batch, d_idx2word, global_step,train_test = 'train')
-    #         S2VT.saveModel(MODEL_FILE_NAME)
-    #     if i * BATCH_SIZE > epoch_count * epoch_size:
-    #         print('Epoch {0} end'.format(epoch_count))
-    #         epoch_count += 1
+    ## picks up the newest checkpoint of MODEL_FILE_NAME_para/ with its loader position
+    runner = TrainingRunner(S2VT, MODEL_FILE_NAME + '_para',
+                            max_to_keep=MAX_CHECKPOINTS, keep_every_hours=KEEP_CHECKPOINT_HOURS,
+                            eval_path=None if EVAL_IN_PROCESS else MODEL_FILE_NAME)
+    state = runner.restore()
+    start_epoch, start_batch = (state['epoch'], state['batch']) if state else (0, 0)
+    global_step = S2VT.sess.run(S2VT.global_step)
+    if state:
+        print('resuming from step {0}, epoch {1} batch {2}'.format(global_step, start_epoch + 1, start_batch))
+    timer = util.StageTimer()
+    trace_path = MODEL_FILE_NAME + '_trace'
+    if TRACE_STEPS and not os.path.exists(trace_path):
+        os.makedirs(trace_path)
+    print ("training start....")
+    for epoch in range(start_epoch, EPOCH):
+        start = start_batch if epoch == start_epoch else 0
+        batches = dataLoader.batch_gen(BATCH_SIZE, num_workers=NUM_WORKERS, seed=SEED, epoch=epoch, start=start)
+        for batch, (frames, captions, target_weights) in enumerate(timer.iterate('loader', batches), start):
+            trace_file = None
+            if TRACE_STEPS and (global_step + 1) % TRACE_STEPS == 0:
+                trace_file = os.path.join(trace_path, 'step_{0}.json'.format(global_step + 1))
+            with timer.stage('train'):
+                cost = S2VT.train(frames, captions, target_weights, trace_path=trace_file)
+            global_step += 1
+            if global_step % 100 == 0:
+                print('global_step {0} cost: {1}'.format(global_step, cost))
+            if global_step % 2000 == 0:
+                if EVAL_IN_PROCESS:
+                    with timer.stage('eval'):
+                        for name, eval_batches, references in eval_sets:
+                            test(S2VT, eval_batches, references, vocab, global_step, train_test=name)
+                ## only the snapshot is taken here, the file is written in the background
+                with timer.stage('checkpoint'):
+                    runner.save(epoch, batch + 1)
+            if global_step % TIMING_STEPS == 0:
+                print('global_step {0} time: {1}'.format(global_step, util.StageTimer.format(timer.summary())))
+        print('Epoch {0} end'.format(epoch + 1))
+    runner.close()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,51 @@
+import contextlib
 import tensorflow as tf
+from tensorflow.python.client import timeline
 import numpy as np
 import random
 
+EOS_ID = 3
+BOS_ID = 4
+## stands in for -inf in log probabilities, -inf * 0 would give nan
+NEG_INF = -1e9
+## compute dtypes of Effective_attention_model, variables are always stored in float32
+PRECISIONS = {'float32': tf.float32, 'float16': tf.float16, 'bfloat16': tf.bfloat16}
+
+## scheduled sampling: probability of feeding the ground truth word, decaying with global_step
+SAMPLING_SCHEDULES = ('linear', 'exponential', 'inverse_sigmoid')
+
+def scheduled_sampling_prob(schedule, global_step, converge, min_prob=0.0):
+    """
+    In-graph teacher forcing probability of step `global_step` (Bengio et al. 2015).
+        linear           1 - step/converge
+        exponential      min_prob^(step/converge), reaches min_prob at converge
+        inverse_sigmoid  sigmoid(10*(converge-step)/converge), 0.5 at converge
+    all clipped below at min_prob.
+    """
+    ratio = tf.cast(global_step, tf.float32) / float(converge)
+    if schedule == 'linear':
+        prob = 1.0 - ratio
+    elif schedule == 'exponential':
+        prob = tf.pow(max(min_prob, 1e-6), ratio)
+    elif schedule == 'inverse_sigmoid':
+        prob = tf.sigmoid(10.0 * (1.0 - ratio))
+    else:
+        raise ValueError('unknown sampling schedule: {0}'.format(schedule))
+    return tf.maximum(prob, min_prob)
+
+def low_precision_getter(dtype):
+    """
+    Variable getter for mixed precision: every float variable is created and
+    updated in float32, the graph reads it through a cast to `dtype`.
+    """
+    ## TensorFlow passes the next getter as the keyword `getter`
+    def custom_getter(getter, *args, **kwargs):
+        if kwargs.get('dtype') in (None, tf.float32, dtype):
+            kwargs['dtype'] = tf.float32
+            return tf.cast(getter(*args, **kwargs), dtype)
+        return getter(*args, **kwargs)
+    return custom_getter
+
 class S2VT_model():
     
     def __init__(self, frame_steps=80.0, frame_feat_dim=4096, caption_steps=45, vocab_size=3000, dim_hidden=300):
@@ -150,7 +194,7 @@ class S2VT_model():
 
 class S2VT_attention_model():
     
-    def __init__(self,frame_steps=20, frame_feat_dim=4096, caption_steps=45, vocab_size=3000, dim_hidden=300):
+    def __init__(self,frame_steps=20, frame_feat_dim=4096, caption_steps=45, vocab_size=3000, dim_hidden=300, training=True):
         
         self.frame_steps = frame_steps
         self.frame_feat_dim = frame_feat_dim
@@ -161,16 +205,9 @@ class S2VT_attention_model():
         ## Graph input
     
         self.frame = tf.placeholder(tf.float32, [None, frame_steps, frame_feat_dim])    
-        self.caption = tf.placeholder(tf.int64, [None,caption_steps+1])
-        self.caption_mask = tf.placeholder(tf.float32, [None, caption_steps+1])
-        self.scheduled_sampling_prob = tf.placeholder(
-            tf.float32, [], name='scheduled_sampling_prob')
-        batch_frame = tf.shape(self.frame)[0]
-        batch_caption = tf.shape(self.caption)[0]
-        tf.Assert(tf.equal(batch_frame, batch_caption), [batch_frame, batch_caption])
-        self.batch_size = batch_frame
-        self.train_state = tf.placeholder(tf.bool)
-        self.keep_prob = tf.placeholder(tf.float32)
+        self.batch_size = tf.shape(self.frame)[0]
+        ## inference never feeds it
+        self.keep_prob = tf.placeholder_with_default(1.0, [])
         
         self.global_step = tf.Variable(0, trainable=False)
         ## frame Embedding param 
@@ -217,7 +254,6 @@ class S2VT_attention_model():
         frame_embedding = tf.reshape(frame_embedding, [self.batch_size, frame_steps, dim_hidden])        
         
         enc_lstm_outputs = []
-        dec_lstm_outputs = []
         ## Encoding stage
         for i in range(frame_steps):
 
@@ -235,6 +271,7 @@ class S2VT_attention_model():
         
         ## (batch_size,frame_step,dim_hidden)
         enc_lstm_outputs = tf.reshape(tf.concat(enc_lstm_outputs , 1),[self.batch_size,self.frame_steps,self.dim_hidden])
+        enc_att_state, enc_cap_state = att_state, cap_state
         
         ## Decoding stage
         ## Training util
@@ -257,43 +294,57 @@ class S2VT_attention_model():
                     tf.concat([word_embed, prev_encoder_output], 1), prev_state)
                 m_state, c_state = state
             return output, m_state, c_state
-        ## Decoding stage
-        prev_step_word = tf.tile(tf.one_hot([4], vocab_size), [self.batch_size, 1])
-        for i in range(caption_steps):
-            
-            with tf.variable_scope('att_lstm'):
-                tf.get_variable_scope().reuse_variables()
-                output1, att_state = att_lstm(padding, att_state)
-                        
-            with tf.variable_scope('cap_lstm'):
-                tf.get_variable_scope().reuse_variables()
-                output2, m_state, c_state = tf.cond(self.train_state, lambda: train_cap(
-                    cap_lstm, output1, self.caption[:, i], prev_step_word, self.global_step, cap_state), lambda: test_cap(cap_lstm, output1, prev_step_word, cap_state))
-                cap_state = (m_state, c_state)
-                prev_step_word = tf.nn.xw_plus_b(
-                    output2, w_word_onehot, b_word_onehot)
-            ## Attention
-            #output2 = self.local_attention(output2,enc_lstm_outputs,wp,vp,wa)
-            #concat_output = tf.concat([attention_output,output2] , 1)
-            #output2 = tf.tanh(tf.matmul(concat_output,wc))  
-            dec_lstm_outputs.append(prev_step_word)
-        
-        onehot_word_logits = tf.reshape(tf.concat(dec_lstm_outputs , 1), [-1,vocab_size])
-        
+        def decode(train):
+            att_state, cap_state = enc_att_state, enc_cap_state
+            dec_lstm_outputs = []
+            prev_step_word = tf.tile(tf.one_hot([4], vocab_size), [self.batch_size, 1])
+            for i in range(caption_steps):
+                
+                with tf.variable_scope('att_lstm'):
+                    tf.get_variable_scope().reuse_variables()
+                    output1, att_state = att_lstm(padding, att_state)
+                            
+                with tf.variable_scope('cap_lstm'):
+                    tf.get_variable_scope().reuse_variables()
+                    if train:
+                        output2, m_state, c_state = train_cap(
+                            cap_lstm, output1, self.caption[:, i], prev_step_word, self.global_step, cap_state)
+                    else:
+                        output2, m_state, c_state = test_cap(cap_lstm, output1, prev_step_word, cap_state)
+                    cap_state = (m_state, c_state)
+                    prev_step_word = tf.nn.xw_plus_b(
+                        output2, w_word_onehot, b_word_onehot)
+                ## Attention
+                #output2 = self.local_attention(output2,enc_lstm_outputs,wp,vp,wa)
+                #concat_output = tf.concat([attention_output,output2] , 1)
+                #output2 = tf.tanh(tf.matmul(concat_output,wc))  
+                dec_lstm_outputs.append(prev_step_word)
+            return tf.reshape(tf.concat(dec_lstm_outputs , 1), [-1,vocab_size])
+
+        ## Inference graph: greedy decoder without scheduled sampling or loss
+        onehot_word_logits = decode(train=False)
         self.predict_result = tf.reshape(tf.argmax(onehot_word_logits[:,2:], 1)+2, [self.batch_size, caption_steps])
-        
-        onehot_word_logits = tf.unstack(tf.reshape(onehot_word_logits,[self.batch_size,caption_steps,vocab_size]),axis = 1)
-        
-        caption_ans = tf.unstack(self.caption[:,1:],axis = 1) 
-  
-        caption_ans_mask = tf.unstack(self.caption_mask[:,1:],axis = 1)     
-        loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(onehot_word_logits,
-                                                                  caption_ans,
-                                                                  caption_ans_mask)
-        
-        self.cost = tf.reduce_mean(loss)
-        #self.global_step = tf.Variable(0, trainable=False)
-        self.train_op = tf.train.AdamOptimizer(learning_rate = 0.001).minimize(self.cost, global_step=self.global_step)
+
+        ## Training graph, sharing every variable with the inference graph
+        if training:
+            self.caption = tf.placeholder(tf.int64, [None,caption_steps+1])
+            self.caption_mask = tf.placeholder(tf.float32, [None, caption_steps+1])
+            self.scheduled_sampling_prob = tf.placeholder(
+                tf.float32, [], name='scheduled_sampling_prob')
+
+            onehot_word_logits = decode(train=True)
+            onehot_word_logits = tf.unstack(tf.reshape(onehot_word_logits,[self.batch_size,caption_steps,vocab_size]),axis = 1)
+            
+            caption_ans = tf.unstack(self.caption[:,1:],axis = 1) 
+      
+            caption_ans_mask = tf.unstack(self.caption_mask[:,1:],axis = 1)     
+            loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(onehot_word_logits,
+                                                                      caption_ans,
+                                                                      caption_ans_mask)
+            
+            self.cost = tf.reduce_mean(loss)
+            #self.global_step = tf.Variable(0, trainable=False)
+            self.train_op = tf.train.AdamOptimizer(learning_rate = 0.001).minimize(self.cost, global_step=self.global_step)
         
 
         config = tf.ConfigProto(log_device_placement = True)
@@ -305,18 +356,12 @@ class S2VT_attention_model():
         _,cost = self.sess.run([self.train_op,self.cost],feed_dict={self.frame:input_frame, 
                                                                     self.caption:input_caption, 
                                                                     self.caption_mask:input_caption_mask,
-                                                                    self.train_state:True,
                                                                     self.scheduled_sampling_prob:scheduled_sampling_prob,
                                                                     self.keep_prob:keep_prob})
         return cost
    
     def predict(self, input_frame):
-        padding = np.zeros([input_frame.shape[0], self.caption_steps + 1])
-        words = self.sess.run([self.predict_result], feed_dict={self.frame: input_frame,
-                                                                self.caption: padding,
-                                                                self.train_state: False,
-                                                                self.scheduled_sampling_prob: 1.0,
-                                                                self.keep_prob: 1.0})
+        words = self.sess.run([self.predict_result], feed_dict={self.frame: input_frame})
         return words
     def initialize(self):
         self.sess.run(tf.global_variables_initializer()) 
@@ -380,237 +425,482 @@ class S2VT_attention_model():
 
 class Effective_attention_model():
   
-    def __init__(self,frame_steps=20, frame_feat_dim=4096, caption_steps=45, vocab_size=3000, dim_hidden=200):
-        
+    def __init__(self,frame_steps=20, frame_feat_dim=4096, caption_steps=45, vocab_size=3000, dim_hidden=200, buckets=None, beam_width=0, training=True, attention='global',
+                 precision='float32', xla=False, embedding_device='/cpu:0', log_device_placement=False,
+                 sampling_schedule=None, sampling_converge=5000, sampling_min_prob=0.0):
+        
+        if attention not in ('global', 'local'):
+            raise ValueError('unknown attention: {0}'.format(attention))
+        if sampling_schedule is not None and sampling_schedule not in SAMPLING_SCHEDULES:
+            raise ValueError('unknown sampling schedule: {0}'.format(sampling_schedule))
+        if precision not in PRECISIONS:
+            raise ValueError('unknown precision: {0}'.format(precision))
+        ## dtype of the activations and matmuls
+        self.dtype = PRECISIONS[precision]
+        ## None leaves the embedding lookup to the default placement
+        self.embedding_device = embedding_device
         self.frame_steps = frame_steps
         self.frame_feat_dim = frame_feat_dim
         self.caption_steps = caption_steps
         self.vocab_size = vocab_size
         self.dim_hidden = dim_hidden
+        ## caption lengths trained through a prefix of the decoder, caption_steps is always one
+        self.buckets = sorted(set(b for b in (buckets or []) if b < caption_steps) | {caption_steps})
     
         ## Graph input
-        self.frame = tf.placeholder(tf.float32, [None, frame_steps, frame_feat_dim])
-        self.caption = tf.placeholder(tf.int64, [None,caption_steps+1])
-        self.caption_mask = tf.placeholder(tf.float32, [None, caption_steps+1])
-        batch_frame = tf.shape(self.frame)[0]
-        batch_caption = tf.shape(self.caption)[0]
-        tf.Assert(tf.equal(batch_frame, batch_caption), [batch_frame, batch_caption])
-        self.batch_size = batch_frame
-        self.train_state = tf.placeholder(tf.bool)
-        self.scheduled_sampling_prob = tf.placeholder(
-                tf.float32, [], name='scheduled_sampling_prob')
-        self.keep_prob = tf.placeholder(tf.float32)
+        ## named inputs and outputs are what export.py keeps in a frozen graph
+        self.frame = tf.placeholder(tf.float32, [None, frame_steps, frame_feat_dim], name='frame')
+        self.batch_size = tf.shape(self.frame)[0]
+        ## number of real frames of every video, all frame_steps unless fed
+        self.frame_lengths = tf.placeholder_with_default(tf.fill([self.batch_size], frame_steps), [None],
+                                                         name='frame_lengths')
+        ## inference never feeds it
+        self.keep_prob = tf.placeholder_with_default(1.0, [])
 
         self.global_step = tf.Variable(0, trainable=False)
-        ## frame Embedding param
-        with tf.variable_scope("frame_embedding"):
-            w_frame_embed = tf.get_variable("w_frame_embed", [frame_feat_dim, 2*dim_hidden], initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))
-            b_frame_embed = tf.get_variable("b_frame_embed", [2*dim_hidden], initializer=tf.constant_initializer(0.0))
-        
-        ## word embedding param
-        with tf.device("/cpu:0"):
-            embedding = tf.get_variable("embedding", [vocab_size, dim_hidden], dtype=tf.float32)
-        
-        ## word embedding to onehot param
-        w_word_onehot = tf.get_variable("w_word_onehot", [dim_hidden, vocab_size], initializer=tf.contrib.layers.xavier_initializer(dtype=tf.float32))
-        b_word_onehot = tf.get_variable("b_word_onehot", [vocab_size], initializer=tf.constant_initializer(0.0))
-        
-        ## attention_position_embedding
-        wp = tf.get_variable("w_position_emb_1", [self.dim_hidden,self.dim_hidden], initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))
-        vp = tf.get_variable("w_position_emb_2", [1,self.dim_hidden], initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))
+        ## the training step, forward and backward, is compiled by XLA
+        jit_scope = tf.contrib.compiler.jit.experimental_jit_scope if xla else contextlib.ExitStack
+        ## in low precision the forward graph reads every float32 variable through a cast
+        custom_getter = low_precision_getter(self.dtype) if self.dtype != tf.float32 else None
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+            ## frame Embedding param
+            with tf.variable_scope("frame_embedding"):
+                w_frame_embed = tf.get_variable("w_frame_embed", [frame_feat_dim, 2*dim_hidden], initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))
+                b_frame_embed = tf.get_variable("b_frame_embed", [2*dim_hidden], initializer=tf.constant_initializer(0.0))
+        
+            ## word embedding param
+            with tf.device(self.embedding_device):
+                embedding = tf.get_variable("embedding", [vocab_size, dim_hidden], dtype=tf.float32)
+        
+            ## word embedding to onehot param
+            w_word_onehot = tf.get_variable("w_word_onehot", [dim_hidden, vocab_size], initializer=tf.contrib.layers.xavier_initializer(dtype=tf.float32))
+            b_word_onehot = tf.get_variable("b_word_onehot", [vocab_size], initializer=tf.constant_initializer(0.0))
+        
+            ## attention_position_embedding
+            wp = tf.get_variable("w_position_emb_1", [self.dim_hidden,self.dim_hidden], initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))
+            vp = tf.get_variable("w_position_emb_2", [1,self.dim_hidden], initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))
 
-        ## attention_align_embedding
-        wa = tf.get_variable("w_align_emb",[self.dim_hidden,self.dim_hidden],initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))        
+            ## attention_align_embedding
+            wa = tf.get_variable("w_align_emb",[self.dim_hidden,self.dim_hidden],initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))        
 
-        ## attention_align_embedding
-        wc = tf.get_variable("w_attention_emb",[2*self.dim_hidden,self.dim_hidden],initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))        
+            ## attention_align_embedding
+            wc = tf.get_variable("w_attention_emb",[2*self.dim_hidden,self.dim_hidden],initializer= tf.contrib.layers.xavier_initializer(dtype=tf.float32))        
 
 
-        ## two lstm param
-        with tf.variable_scope("att_lstm"):
-            att_lstm = tf.contrib.rnn.LSTMCell(dim_hidden)
-            att_lstm = tf.contrib.rnn.DropoutWrapper(att_lstm,input_keep_prob=self.keep_prob, output_keep_prob=self.keep_prob)
-        with tf.variable_scope("cap_lstm"):
-            cap_lstm = tf.contrib.rnn.LSTMCell(dim_hidden)        
-            cap_lstm = tf.contrib.rnn.DropoutWrapper(cap_lstm,input_keep_prob=self.keep_prob, output_keep_prob=self.keep_prob)                
-        
-        att_state = (tf.zeros([self.batch_size, dim_hidden]),tf.zeros([self.batch_size, dim_hidden]))
-        cap_state = (tf.zeros([self.batch_size, dim_hidden]),tf.zeros([self.batch_size, dim_hidden]))
-        
-        padding = tf.zeros([self.batch_size, dim_hidden])
-        
-        ##################### Computing Graph ########################
-        
-        frame_flat = tf.reshape(self.frame, [-1, frame_feat_dim])
-        frame_embedding = tf.nn.xw_plus_b( frame_flat, w_frame_embed, b_frame_embed )
-        frame_embedding = tf.reshape(frame_embedding, [self.batch_size, frame_steps, 2*dim_hidden])        
-        
-        enc_lstm_outputs = []
-        dec_lstm_outputs = []
-        ## Encoding stage
-        for i in range(frame_steps):
+            ## dynamic_rnn wants the LSTMStateTuple structure the cells return
+            att_state = tf.contrib.rnn.LSTMStateTuple(tf.zeros([self.batch_size, dim_hidden], self.dtype),tf.zeros([self.batch_size, dim_hidden], self.dtype))
+            cap_state = tf.contrib.rnn.LSTMStateTuple(tf.zeros([self.batch_size, dim_hidden], self.dtype),tf.zeros([self.batch_size, dim_hidden], self.dtype))
 
-            with tf.variable_scope('att_lstm'):
-                if i > 0:
+            ## dropout needs keep_prob in the dtype of the activations
+            keep_prob = tf.cast(self.keep_prob, self.dtype)
+            ## two lstm param
+            ## each cell is built by a first call here, outside the encoder's while loop: the
+            ## getter casts the weights when they are created, and the decoders can only use
+            ## casts made outside that loop. The call's outputs are never run.
+            with tf.variable_scope("att_lstm"):
+                att_lstm = tf.contrib.rnn.LSTMCell(dim_hidden)
+                att_lstm(tf.zeros([self.batch_size, 2*dim_hidden], self.dtype), att_state)
+                att_lstm = tf.contrib.rnn.DropoutWrapper(att_lstm,input_keep_prob=keep_prob, output_keep_prob=keep_prob)
+            with tf.variable_scope("cap_lstm"):
+                cap_lstm = tf.contrib.rnn.LSTMCell(dim_hidden)        
+                cap_lstm(tf.zeros([self.batch_size, dim_hidden], self.dtype), cap_state)
+                cap_lstm = tf.contrib.rnn.DropoutWrapper(cap_lstm,input_keep_prob=keep_prob, output_keep_prob=keep_prob)                
+        
+            padding = tf.zeros([self.batch_size, dim_hidden], self.dtype)
+        
+            ##################### Computing Graph ########################
+        
+            frame_flat = tf.reshape(tf.cast(self.frame, self.dtype), [-1, frame_feat_dim])
+            frame_embedding = tf.nn.xw_plus_b( frame_flat, w_frame_embed, b_frame_embed )
+            frame_embedding = tf.reshape(frame_embedding, [self.batch_size, frame_steps, 2*dim_hidden])        
+        
+            ## Encoding stage
+            ## one while loop per layer instead of frame_steps unrolled cells, so the
+            ## graph does not grow with frame_steps. Passing the current scope keeps
+            ## the variable names the decoder and old checkpoints use.
+            with tf.variable_scope('att_lstm') as scope:
+                att_outputs, att_state = tf.nn.dynamic_rnn(att_lstm, frame_embedding, sequence_length=self.frame_lengths,
+                                                           initial_state=att_state, scope=scope)
+            with tf.variable_scope('cap_lstm') as scope:
+                ## (batch_size,frame_step,dim_hidden)
+                enc_lstm_outputs, cap_state = tf.nn.dynamic_rnn(cap_lstm, att_outputs, sequence_length=self.frame_lengths,
+                                                                initial_state=cap_state, scope=scope)
+            att_state, cap_state = tuple(att_state), tuple(cap_state)
+            enc_att_state, enc_cap_state = att_state, cap_state
+            ## attention memory: encoder outputs and their keys, projected once per batch
+            ## and which frames exist, padded frames get no attention
+            frame_mask = tf.sequence_mask(self.frame_lengths, frame_steps, dtype=tf.float32)
+            enc_memory = (enc_lstm_outputs, self.attention_keys(enc_lstm_outputs, wa), frame_mask)
+        
+            def attend(decode_vec, enc_memory):
+                encode_vecs, encode_keys, frame_mask = enc_memory
+                if attention == 'local':
+                    return self.local_attention(decode_vec, encode_vecs, encode_keys, wp, vp, frame_mask)
+                return self.global_attention(decode_vec, encode_vecs, encode_keys, frame_mask)
+
+            ## Decoding stage
+            ## Training util
+            def train_cap(input_lstm,real_ans,prev_decoder_output,prev_attention_output,global_step,prev_state):
+            
+               with tf.device(self.embedding_device):
+                  ## drawn per example, every caption of the batch decides on its own
+                  word_index = tf.where(self.scheduled_sampling_prob >= tf.random_uniform([self.batch_size], 0, 1),
+                                        real_ans,
+                                        tf.argmax(prev_decoder_output, axis=1))
+                  #word_index = tf.argmax(real_ans, axis=1)
+                  word_embed = tf.nn.embedding_lookup(embedding, word_index)      
+               output, state = input_lstm(tf.concat([word_embed, prev_attention_output], 1), prev_state)
+               m_state, c_state = state
+               return output, m_state, c_state
+            def decode(steps, caption):
+                att_state, cap_state = enc_att_state, enc_cap_state
+                dec_lstm_outputs = []
+                prev_step_word = tf.tile(tf.one_hot([4], vocab_size), [self.batch_size, 1])
+                attention_output = tf.zeros(shape = [self.batch_size,dim_hidden], dtype = self.dtype)
+                ## Decoding stage
+                for i in range(steps):
+                
+                    with tf.variable_scope('att_lstm'):
+                        tf.get_variable_scope().reuse_variables()
+                        output1, m_state, c_state = train_cap(att_lstm, caption[:,i],prev_step_word,attention_output,self.global_step,att_state)
+                        att_state = (m_state, c_state)
+                            
+                    with tf.variable_scope('cap_lstm'):
+                        tf.get_variable_scope().reuse_variables()
+                        output2, cap_state = cap_lstm(output1,cap_state)
+                    ## Attention
+                    attention_output = attend(output2,enc_memory)
+                    concat_output = tf.concat([attention_output,output2] , 1)
+                    attention_output = tf.tanh(tf.matmul(concat_output,wc))  
+                    prev_step_word = tf.nn.xw_plus_b(attention_output, w_word_onehot, b_word_onehot)
+                    dec_lstm_outputs.append(prev_step_word)
+                return dec_lstm_outputs
+
+            ## Training graph: the scheduled sampling decoder,
+            ## left out entirely when the model is only used for inference
+            if training:
+                ## caption_steps+1 columns, or bucket+1 for a bucket's train_op
+                self.caption = tf.placeholder(tf.int64, [None, None])
+                self.caption_mask = tf.placeholder(tf.float32, [None, None])
+                ## without a schedule the caller feeds the probability to train()
+                self.sampling_schedule = sampling_schedule
+                if sampling_schedule is None:
+                    self.scheduled_sampling_prob = tf.placeholder_with_default(
+                            0.0, [], name='scheduled_sampling_prob')
+                else:
+                    self.scheduled_sampling_prob = scheduled_sampling_prob(sampling_schedule, self.global_step,
+                                                                           sampling_converge, sampling_min_prob)
+
+                ## one decoder unroll of caption_steps steps shared by every bucket. A bucket's
+                ## loss only reads its first `steps` outputs, so its train_op runs that prefix
+                ## and is fed captions of steps+1 columns
+                with jit_scope():
+                    dec_lstm_outputs = decode(caption_steps, self.caption)
+
+            ## Inference decoding, one step of the decoder fed with the chosen word
+            def decode_step(word_index, attention_output, att_state, cap_state, enc_memory):
+                with tf.variable_scope('att_lstm'):
                     tf.get_variable_scope().reuse_variables()
-                output1, att_state = att_lstm(frame_embedding[:,i,:], att_state)
-            ##input shape of cap_lstm2: [batch_size, 2*dim_hidden]
-            with tf.variable_scope('cap_lstm'):
-                if i > 0:
+                    with tf.device(self.embedding_device):
+                        word_embed = tf.nn.embedding_lookup(embedding, word_index)
+                    output1, att_state = att_lstm(tf.concat([word_embed, attention_output], 1), att_state)
+                with tf.variable_scope('cap_lstm'):
                     tf.get_variable_scope().reuse_variables()
-                output2, cap_state = cap_lstm(output1, cap_state)
-            enc_lstm_outputs.append(output2)
-        
-        ## (batch_size,frame_step,dim_hidden)
-        enc_lstm_outputs = tf.reshape(tf.concat(enc_lstm_outputs , 1),[self.batch_size,self.frame_steps,self.dim_hidden])
-        
-        ## Decoding stage
-        ## Training util
-        def train_cap(input_lstm,real_ans,prev_decoder_output,prev_attention_output,global_step,prev_state):
-            
-           with tf.device('cpu:0'):
-              word_index = tf.cond(self.scheduled_sampling_prob >= tf.random_uniform([], 0, 1),
-                                lambda:real_ans,
-                                lambda:tf.argmax(prev_decoder_output, axis=1))
-              #word_index = tf.argmax(real_ans, axis=1)
-              word_embed = tf.nn.embedding_lookup(embedding, word_index)      
-           output, state = input_lstm(tf.concat([word_embed, prev_attention_output], 1), prev_state)
-           m_state, c_state = state
-           return output, m_state, c_state
-        def test_cap(input_lstm, prev_decoder_output, prev_attention_output,prev_state):
-            ##  TODO: beam search
-            with tf.device('cpu:0'):
-                word_index = tf.argmax(prev_decoder_output, axis=1)
-                word_embed = tf.nn.embedding_lookup(embedding, word_index)
-                output, state = input_lstm(
-                    tf.concat([word_embed,prev_attention_output], 1), prev_state)
-                m_state, c_state = state
-            return output, m_state, c_state
-        prev_step_word = tf.tile(tf.one_hot([4], vocab_size), [self.batch_size, 1])
-        attention_output = tf.zeros(shape = [self.batch_size,dim_hidden])
-        ## Decoding stage
-        for i in range(caption_steps):
-            
-            with tf.variable_scope('att_lstm'):
-                tf.get_variable_scope().reuse_variables()
-                output1, m_state, c_state = tf.cond(self.train_state, lambda: train_cap(att_lstm, self.caption[:,i],prev_step_word,attention_output,self.global_step,att_state), lambda: test_cap(att_lstm, prev_step_word,attention_output,att_state))
-                att_state = (m_state, c_state)
-                        
-            with tf.variable_scope('cap_lstm'):
-                tf.get_variable_scope().reuse_variables()
-                output2, cap_state = cap_lstm(output1,cap_state)
-            ## Attention
-            attention_output = self.global_attention(output2,enc_lstm_outputs,wa)
-            #attention_output = self.local_attention(output2,enc_lstm_outputs,wp,vp,wa)
-            concat_output = tf.concat([attention_output,output2] , 1)
-            attention_output = tf.tanh(tf.matmul(concat_output,wc))  
-            prev_step_word = tf.nn.xw_plus_b(attention_output, w_word_onehot, b_word_onehot)
-            dec_lstm_outputs.append(prev_step_word)
+                    output2, cap_state = cap_lstm(output1, cap_state)
+                attention_output = attend(output2, enc_memory)
+                attention_output = tf.tanh(tf.matmul(tf.concat([attention_output, output2], 1), wc))
+                logits = tf.cast(tf.nn.xw_plus_b(attention_output, w_word_onehot, b_word_onehot), tf.float32)
+                return logits, attention_output, tuple(att_state), tuple(cap_state)
 
-        onehot_word_logits = tf.reshape(tf.concat(dec_lstm_outputs , 1), [-1,vocab_size])
-        
-        self.predict_result = tf.reshape(tf.argmax(onehot_word_logits[:,2:], 1)+2, [self.batch_size, caption_steps])
-        
-        onehot_word_logits = tf.unstack(tf.reshape(onehot_word_logits,[self.batch_size,caption_steps,vocab_size]),axis = 1)
-        
-        caption_ans = tf.unstack(self.caption[:,1:],axis = 1) 
-  
-        caption_ans_mask = tf.unstack(self.caption_mask[:,1:],axis = 1)     
-        loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(onehot_word_logits,
-                                                                  caption_ans,
-                                                                  caption_ans_mask)
-        
-        self.cost = tf.reduce_mean(loss)
-        #self.global_step = tf.Variable(0, trainable=False)
-        self.train_op = tf.train.AdamOptimizer(learning_rate = 0.001).minimize(self.cost, global_step=self.global_step)
+            self.greedy_result = tf.identity(self.greedy_search(decode_step, enc_memory,
+                                                                tuple(enc_att_state), tuple(enc_cap_state)),
+                                             name='greedy_result')
+            self.beam_width = beam_width
+            if beam_width > 0:
+                self.length_penalty = tf.placeholder_with_default(0.6, [], name='length_penalty')
+                self.beam_result = tf.identity(self.beam_search(decode_step, enc_memory,
+                                                                tuple(enc_att_state), tuple(enc_cap_state), beam_width),
+                                               name='beam_result')
         
 
-        config = tf.ConfigProto(log_device_placement = True)
+        ## Training step: the loss of every bucket and the optimizer, outside the
+        ## custom getter so the Adam slots are float32 variables of their own
+        if training:
+            ## Adam slots are created once and shared by every bucket's train_op
+            optimizer = tf.train.AdamOptimizer(learning_rate = 0.001)
+            if self.dtype == tf.float16:
+                ## float16 gradients underflow, scale the loss up and skip steps that overflow
+                optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(
+                    optimizer, tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(2**15, 2000))
+            self.bucket_ops = {}
+            for steps in self.buckets:
+                with jit_scope():
+                    ## loss in float32 whatever the compute dtype
+                    onehot_word_logits = [tf.cast(output, tf.float32) for output in dec_lstm_outputs[:steps]]
+                
+                    caption_ans = tf.unstack(self.caption[:,1:steps+1], num=steps, axis=1) 
+          
+                    caption_ans_mask = tf.unstack(self.caption_mask[:,1:steps+1], num=steps, axis=1)     
+                    loss = tf.contrib.legacy_seq2seq.sequence_loss_by_example(onehot_word_logits,
+                                                                              caption_ans,
+                                                                              caption_ans_mask)
+                
+                    cost = tf.reduce_mean(loss)
+                    train_op = optimizer.minimize(cost, global_step=self.global_step)
+                self.bucket_ops[steps] = (cost, train_op)
+            self.cost, self.train_op = self.bucket_ops[caption_steps]
+
+        config = tf.ConfigProto(log_device_placement = log_device_placement)
         config.gpu_options.allow_growth = True
         
         self.sess = tf.Session(config=config)
+        ## built once and keeps every checkpoint, a Saver per save or load would keep adding ops to the graph
+        self.saver = tf.train.Saver(max_to_keep=None)
 
-    def train(self, input_frame, input_caption,input_caption_mask, keep_prob=0.5, scheduled_sampling_prob=0.0):
-        _,cost = self.sess.run([self.train_op,self.cost],feed_dict={self.frame:input_frame, 
-                                                                    self.caption:input_caption, 
-                                                                    self.caption_mask:input_caption_mask,
-                                                                    self.train_state:True,
-                                                                    self.scheduled_sampling_prob:scheduled_sampling_prob,
-                                                                    self.keep_prob:keep_prob})
+    def bucket_for(self, steps):
+        for bucket in self.buckets:
+            if steps <= bucket:
+                return bucket
+        return self.caption_steps
+
+    def train(self, input_frame, input_caption,input_caption_mask, keep_prob=0.5, scheduled_sampling_prob=None, trace_path=None):
+        steps = self.bucket_for(input_caption.shape[1] - 1)
+        cost_op, train_op = self.bucket_ops[steps]
+        if input_caption.shape[1] < steps + 1:
+            pad = ((0, 0), (0, steps + 1 - input_caption.shape[1]))
+            input_caption = np.pad(input_caption, pad, 'constant')
+            input_caption_mask = np.pad(input_caption_mask, pad, 'constant')
+        ## with trace_path, the step is traced and saved as a Chrome trace (chrome://tracing)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if trace_path else None
+        run_metadata = tf.RunMetadata() if trace_path else None
+        feed_dict = {self.frame:input_frame, 
+                     self.caption:input_caption, 
+                     self.caption_mask:input_caption_mask,
+                     self.keep_prob:keep_prob}
+        ## overrides the schedule if there is one
+        if scheduled_sampling_prob is not None:
+            feed_dict[self.scheduled_sampling_prob] = scheduled_sampling_prob
+        _,cost = self.sess.run([train_op,cost_op],feed_dict=feed_dict,
+                               options=options, run_metadata=run_metadata)
+        if trace_path:
+            with open(trace_path, 'w') as f:
+                f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
         return cost
    
     def predict(self, input_frame):
-        padding = np.zeros([input_frame.shape[0], self.caption_steps + 1])
-        words = self.sess.run([self.predict_result], feed_dict={self.frame: input_frame,
-                                                                self.caption: padding,
-                                                                self.train_state: False,
-                                                                self.scheduled_sampling_prob:1.0,
-                                                                self.keep_prob:1.0})
+        words = self.sess.run([self.greedy_result], feed_dict={self.frame: input_frame})
+        return words
+
+    def predict_beam(self, input_frame, length_penalty=0.6):
+        words = self.sess.run([self.beam_result], feed_dict={self.frame: input_frame,
+                                                             self.length_penalty: length_penalty})
         return words
     def initialize(self):
         self.sess.run(tf.global_variables_initializer()) 
 
+    def greedy_search(self, step, enc_memory, att_state, cap_state):
+        """
+        Greedy decoding that stops as soon as every caption of the batch has
+        emitted <eos>, instead of always running caption_steps steps.
+        Returns (batch_size, caption_steps) word ids, padded with <eos>.
+        """
+        batch_size = self.batch_size
+        ## padding and unknown are never emitted, but like the unrolled decoder
+        ## the next step is still fed the unmasked argmax
+        word_mask = tf.constant([NEG_INF, NEG_INF] + [0.0] * (self.vocab_size - 2))
+        eos = tf.fill([batch_size], tf.constant(EOS_ID, dtype=tf.int64))
+
+        def cond(i, word_index, attention_output, att_state, cap_state, finished, words):
+            return tf.logical_and(i < self.caption_steps, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(i, word_index, attention_output, att_state, cap_state, finished, words):
+            logits, attention_output, att_state, cap_state = step(word_index, attention_output,
+                                                                  att_state, cap_state, enc_memory)
+            word = tf.where(finished, eos, tf.argmax(logits + word_mask, axis=1))
+            finished = tf.logical_or(finished, tf.equal(word, EOS_ID))
+            word_index = tf.argmax(logits, axis=1)
+            return i + 1, word_index, attention_output, att_state, cap_state, finished, words.write(i, word)
+
+        loop_vars = [tf.constant(0),
+                     tf.fill([batch_size], tf.constant(BOS_ID, dtype=tf.int64)),
+                     tf.zeros([batch_size, self.dim_hidden], self.dtype),
+                     att_state, cap_state,
+                     tf.zeros([batch_size], dtype=tf.bool),
+                     tf.TensorArray(tf.int64, size=0, dynamic_size=True)]
+        words = tf.while_loop(cond, body, loop_vars)[-1]
+        ## (steps, batch_size) -> (batch_size, steps)
+        words = tf.transpose(words.stack(), [1, 0])
+        eos_padding = tf.fill([batch_size, self.caption_steps - tf.shape(words)[1]],
+                              tf.constant(EOS_ID, dtype=tf.int64))
+        return tf.concat([words, eos_padding], 1)
+
+    def beam_search(self, step, enc_memory, att_state, cap_state, beam_width):
+        """
+        Batched beam search over the whole input batch, every video keeps
+        `beam_width` hypotheses. A finished hypothesis can only be extended with
+        <eos> at no cost, and the loop stops as soon as all of them are finished.
+        The best hypothesis of each video is picked by its score normalized with
+        the GNMT length penalty ((5+length)/6)^length_penalty.
+        Returns (batch_size, steps) word ids, padded with <eos>.
+        """
+        batch_size = self.batch_size
+        vocab_size = self.vocab_size
+        flat_size = batch_size * beam_width
+
+        def tile_beam(t):
+            ## (batch_size, ...) -> (batch_size*beam_width, ...), beams of a video are adjacent
+            t = tf.expand_dims(t, 1)
+            t = tf.tile(t, [1, beam_width] + [1] * (t.get_shape().ndims - 2))
+            return tf.reshape(t, tf.concat([[flat_size], tf.shape(t)[2:]], 0))
 
+        enc_memory = tuple(tile_beam(t) for t in enc_memory)
+        att_state = tuple(tile_beam(s) for s in att_state)
+        cap_state = tuple(tile_beam(s) for s in cap_state)
+        attention_output = tf.zeros([flat_size, self.dim_hidden], self.dtype)
+        word_index = tf.fill([flat_size], tf.constant(BOS_ID, dtype=tf.int64))
+        ## only the first beam is alive at the start, so the top k are not k copies
+        scores = tf.tile(tf.constant([[0.0] + [NEG_INF] * (beam_width - 1)]), [batch_size, 1])
+        finished = tf.zeros([batch_size, beam_width], dtype=tf.bool)
+        lengths = tf.zeros([batch_size, beam_width], dtype=tf.float32)
+        sequences = tf.zeros([flat_size, 0], dtype=tf.int64)
 
-    def global_attention(self,decode_vec,encode_vecs,wa):
+        ## padding and unknown are never emitted
+        word_mask = tf.constant([NEG_INF, NEG_INF] + [0.0] * (vocab_size - 2))
+        eos_only = tf.one_hot(EOS_ID, vocab_size, on_value=0.0, off_value=NEG_INF)
+        beam_offset = tf.expand_dims(tf.range(batch_size) * beam_width, 1)
+
+        def cond(i, word_index, attention_output, att_state, cap_state, finished, scores, lengths, sequences):
+            return tf.logical_and(i < self.caption_steps, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(i, word_index, attention_output, att_state, cap_state, finished, scores, lengths, sequences):
+            logits, attention_output, att_state, cap_state = step(word_index, attention_output,
+                                                                  att_state, cap_state, enc_memory)
+            log_probs = tf.reshape(tf.nn.log_softmax(logits) + word_mask, [batch_size, beam_width, vocab_size])
+            done = tf.expand_dims(tf.cast(finished, tf.float32), 2)
+            log_probs = log_probs * (1 - done) + eos_only * done
+            ## (batch_size, beam_width*vocab_size)
+            total = tf.reshape(tf.expand_dims(scores, 2) + log_probs, [batch_size, -1])
+            scores, index = tf.nn.top_k(total, k=beam_width)
+            parent = index // vocab_size
+            word = tf.cast(index % vocab_size, tf.int64)
+
+            flat_parent = tf.reshape(parent + beam_offset, [-1])
+            attention_output = tf.gather(attention_output, flat_parent)
+            att_state = tuple(tf.gather(s, flat_parent) for s in att_state)
+            cap_state = tuple(tf.gather(s, flat_parent) for s in cap_state)
+            prev_finished = tf.reshape(tf.gather(tf.reshape(finished, [-1]), flat_parent), [batch_size, beam_width])
+            lengths = tf.reshape(tf.gather(tf.reshape(lengths, [-1]), flat_parent), [batch_size, beam_width])
+            lengths += 1.0 - tf.cast(prev_finished, tf.float32)
+            finished = tf.logical_or(prev_finished, tf.equal(word, EOS_ID))
+            word_index = tf.reshape(word, [-1])
+            sequences = tf.concat([tf.gather(sequences, flat_parent), tf.expand_dims(word_index, 1)], 1)
+            return i + 1, word_index, attention_output, att_state, cap_state, finished, scores, lengths, sequences
+
+        loop_vars = [tf.constant(0), word_index, attention_output, att_state, cap_state,
+                     finished, scores, lengths, sequences]
+        shape_invariants = [tf.TensorShape([]), tf.TensorShape([None]), tf.TensorShape([None, self.dim_hidden]),
+                            tuple(tf.TensorShape([None, self.dim_hidden]) for _ in att_state),
+                            tuple(tf.TensorShape([None, self.dim_hidden]) for _ in cap_state),
+                            tf.TensorShape([None, beam_width]), tf.TensorShape([None, beam_width]),
+                            tf.TensorShape([None, beam_width]), tf.TensorShape([None, None])]
+        _, _, _, _, _, finished, scores, lengths, sequences = tf.while_loop(
+            cond, body, loop_vars, shape_invariants=shape_invariants)
+
+        penalty = tf.pow((5.0 + lengths) / 6.0, self.length_penalty)
+        best = tf.cast(tf.argmax(scores / penalty, axis=1), tf.int32)
+        sequences = tf.gather(sequences, tf.range(batch_size) * beam_width + best)
+        ## pad to caption_steps so the result has the same shape as greedy_result
+        eos_padding = tf.fill([batch_size, self.caption_steps - tf.shape(sequences)[1]],
+                              tf.constant(EOS_ID, dtype=tf.int64))
+        return tf.concat([sequences, eos_padding], 1)
+
+    def global_attention(self,decode_vec,encode_vecs,encode_keys,frame_mask):
         ## (batch_size,frame_step)
-        score = tf.nn.softmax(self.score(decode_vec,encode_vecs,wa))
-        attention_vec = tf.reduce_sum(encode_vecs*tf.tile(tf.expand_dims(score,2),[1,1,self.dim_hidden]),1  )
-        
-        return attention_vec
-    def local_attention(self,decode_vec,encode_vecs,wp,vp,wa):
+        score = tf.nn.softmax(self.score(decode_vec,encode_keys) + (1.0-frame_mask)*NEG_INF)
+        ## (batch_size,1,frame_step)*(batch_size,frame_step,dim_hidden)
+        attention_vec = tf.matmul(tf.expand_dims(tf.cast(score,encode_vecs.dtype),1),encode_vecs)
+        ## (batch_size,dim_hidden)
+        return tf.reshape(attention_vec,[-1,self.dim_hidden])
+    def local_attention(self,decode_vec,encode_vecs,encode_keys,wp,vp,frame_mask):
 
         ## (batch_size,frame_step)
-        score = self.score(decode_vec,encode_vecs,wa)
+        score = self.score(decode_vec,encode_keys)
         ## (dim_hidden,batch_size)
         decode_vec_t = tf.transpose(decode_vec,[1,0])
         ## (1,batch_size)
         pos_feature = tf.matmul(vp,tf.tanh(tf.matmul(wp,decode_vec_t)))
-        ## (1,batch_size)
-        pt = tf.reshape(self.frame_steps*tf.sigmoid(pos_feature),[self.batch_size])
+        ## (batch_size,1)
+        ## positions are spread over the real frames of each video
+        pt = tf.reduce_sum(frame_mask,1,keep_dims=True)*tf.reshape(tf.sigmoid(tf.cast(pos_feature,tf.float32)),[-1,1])
         local_center = tf.round(pt)
 
         half_window = 2 #tf.constant(4,shape = [1])
         delta = half_window/2
-        
-        def index_frame(ele):
-            frames_ind,center_ind,pt_ind,score_ind = ele
-            right = tf.minimum(center_ind+half_window+1,self.frame_steps)
-            left = tf.maximum(center_ind-half_window,0)
-            right = tf.cast(right,tf.int32)
-            left = tf.cast(left,tf.int32)
-            frames_ind = frames_ind[left:right,:]
-            score_ind  = tf.nn.softmax(score_ind[left:right])
-            s = tf.range(self.frame_steps,dtype = tf.float32)
-            s = s[left:right]
-            score_ind =  score_ind*tf.exp(-tf.square(s-pt_ind)/(2*delta*delta))
-            score_ind = tf.expand_dims(score_ind,0)
-            attention_vec = tf.matmul(score_ind,frames_ind)
-            attention_vec = tf.reshape(attention_vec,[self.dim_hidden])
-            return attention_vec
+
+        ## every frame position at once instead of slicing a window per example
+        ## (1,frame_step)
+        s = tf.expand_dims(tf.range(self.frame_steps,dtype = tf.float32),0)
+        ## (batch_size,frame_step), softmax only over the window around the center
+        in_window = tf.cast(tf.abs(s-local_center) <= half_window, tf.float32)*frame_mask
+        score = tf.nn.softmax(score + (1.0-in_window)*NEG_INF)
+        score = score*in_window*tf.exp(-tf.square(s-pt)/(2*delta*delta))
+        ## (batch_size,1,frame_step)*(batch_size,frame_step,dim_hidden)
+        attention_vec = tf.matmul(tf.expand_dims(tf.cast(score,encode_vecs.dtype),1),encode_vecs)
         ## (batch_size,dim_hidden)
-        attention_vec = tf.map_fn(index_frame,[encode_vecs,local_center,pt,score],dtype=tf.float32)
-        return attention_vec
+        return tf.reshape(attention_vec,[-1,self.dim_hidden])
                                 
     def saveModel(self,filepath):
         global_step = self.sess.run(self.global_step)
-        saver = tf.train.Saver()
-        saver.save(self.sess, './'+filepath+'_para/model_%d.ckpt' % (global_step))
+        self.saver.save(self.sess, './'+filepath+'_para/model_%d.ckpt' % (global_step))
         
     def loadModel(self, model_path):
-        saver = tf.train.Saver(restore_sequentially=True)
-        saver.restore(self.sess, model_path)
+        self.saver.restore(self.sess, model_path)
     
 
-    def score(self,decode_vec,encode_vecs,wa):
-        ## (batch_size,dim_hidden,frame_step)
-        encode_vecs_t = tf.transpose(encode_vecs,[0,2,1])
-        ## (batch_size,1,dim_hidden)*(batch_size,dim_hidden,frame_step)
-        score = tf.matmul(tf.expand_dims(tf.matmul(decode_vec,wa),1),encode_vecs_t)
-        score = tf.reshape(score,[self.batch_size,self.frame_steps])
-        ## (batch_size,frame_step)
-        
-        return score
+    def attention_keys(self,encode_vecs,wa):
+        ## decode_vec*wa*encode_vec^T == decode_vec*(encode_vec*wa^T)^T, so the
+        ## encoder side is projected once instead of at every decoder step
+        keys = tf.matmul(tf.reshape(encode_vecs,[-1,self.dim_hidden]),wa,transpose_b=True)
+        ## (batch_size,frame_step,dim_hidden)
+        return tf.reshape(keys,[-1,self.frame_steps,self.dim_hidden])
+
+    def score(self,decode_vec,encode_keys):
+        ## (batch_size,frame_step,dim_hidden)*(batch_size,dim_hidden,1)
+        score = tf.matmul(encode_keys,tf.expand_dims(decode_vec,2))
+        ## (batch_size,frame_step), softmax is taken in float32
+        return tf.cast(tf.reshape(score,[-1,self.frame_steps]),tf.float32)
+
+
+class Frozen_inference_model():
+    """
+    Effective_attention_model inference from a graph frozen by export.py,
+    no model is built and no checkpoint restored.
+    """
+    def __init__(self, graph_path):
+        graph_def = tf.GraphDef()
+        with open(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        names = set(node.name for node in graph_def.node)
+        self.frame = self.graph.get_tensor_by_name('frame:0')
+        self.greedy_result = self.graph.get_tensor_by_name('greedy_result:0')
+        self.beam_result = self.graph.get_tensor_by_name('beam_result:0') if 'beam_result' in names else None
+        self.length_penalty = self.graph.get_tensor_by_name('length_penalty:0') if 'length_penalty' in names else None
+        self.sess = tf.Session(graph=self.graph)
+
+    def predict(self, input_frame):
+        words = self.sess.run([self.greedy_result], feed_dict={self.frame: input_frame})
+        return words
+
+    def predict_beam(self, input_frame, length_penalty=0.6):
+        if self.beam_result is None:
+            raise ValueError('graph was exported without beam search')
+        words = self.sess.run([self.beam_result], feed_dict={self.frame: input_frame,
+                                                             self.length_penalty: length_penalty})
+        return words
+
 """
 class Adversary_S2VT_model():
 
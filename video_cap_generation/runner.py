@@ -0,0 +1,155 @@
+"""
+Restartable training state for the captioning models.
+
+TrainingRunner owns the one Saver of a training run. `save()` only copies
+the variables into snapshot variables on the training thread, a background
+thread then writes that snapshot, so training goes on while the checkpoint
+is written and the checkpoint still holds a single step. Only the newest
+`max_to_keep` checkpoints are kept, plus one every `keep_every_hours`.
+With `eval_path`, the directory evaluate.py writes metrics_<step>.json
+into, an older checkpoint is only deleted once it has been scored, so the
+evaluator never finds its checkpoint pruned however far behind it is.
+Until then it stays on disk beyond `max_to_keep`.
+
+Next to each model_<step>.ckpt it writes model_<step>.ckpt.state.json with
+the loader position (epoch, batch) and the numpy and python RNG states.
+`restore()` loads the newest checkpoint and returns that state, so
+
+    runner = TrainingRunner(S2VT, 'result_para')
+    state = runner.restore()
+    ## then dataLoader.batch_gen(..., epoch=state['epoch'], start=state['batch'])
+    ## and after every N batches runner.save(epoch, batch + 1)
+    runner.close()
+
+resumes at the first batch the checkpoint has not seen. The checkpoints
+have the variable names of `model.saveModel`, both load the other's files.
+"""
+import os
+import re
+import glob
+import json
+import time
+import queue
+import random
+import threading
+import numpy as np
+import tensorflow as tf
+
+CKPT_FILE = 'model_{0}.ckpt'
+STATE_PATTERN = re.compile(r'^model_(\d+)\.ckpt\.state\.json$')
+## written by evaluate.py once the checkpoint of that step is scored
+METRICS_FILE = 'metrics_{0}.json'
+
+
+class TrainingRunner():
+    def __init__(self, model, checkpoint_dir, max_to_keep=5, keep_every_hours=10000.0, eval_path=None):
+        self.model = model
+        self.checkpoint_dir = checkpoint_dir
+        self.max_to_keep = max_to_keep
+        self.keep_every_hours = keep_every_hours
+        self.eval_path = eval_path
+        self.kept_time = time.time()
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        variables = tf.global_variables()
+        with tf.variable_scope('checkpoint_snapshot'):
+            ## local variables, so no other Saver or initializer picks them up
+            self.snapshots = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype), trainable=False,
+                                          collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                          name=v.op.name.replace('/', '_'))
+                              for v in variables]
+        self.snapshot_op = tf.group(*[s.assign(v) for v, s in zip(variables, self.snapshots)])
+        self.restore_op = tf.group(*[v.assign(s) for v, s in zip(variables, self.snapshots)])
+        ## saved under the names of the original variables, old checkpoints are deleted by _prune
+        self.saver = tf.train.Saver(dict((v.op.name, s) for v, s in zip(variables, self.snapshots)),
+                                    max_to_keep=None)
+        self.model.sess.run(tf.variables_initializer(self.snapshots))
+
+        ## holds at most the one snapshot being written
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            path, state = item
+            try:
+                self.saver.save(self.model.sess, path, write_meta_graph=False)
+                with open(path + '.state.json', 'w') as f:
+                    json.dump(state, f)
+                self._prune()
+            except Exception as e:
+                self.error = e
+            self.pending.task_done()
+
+    def _prune(self):
+        ## only checkpoints with a state file, the ones of saveModel are never deleted
+        steps = sorted(int(match.group(1)) for match in map(STATE_PATTERN.match, os.listdir(self.checkpoint_dir))
+                       if match is not None)
+        for step in steps[:-self.max_to_keep] if self.max_to_keep else []:
+            path = os.path.join(self.checkpoint_dir, CKPT_FILE.format(step))
+            with open(path + '.state.json') as f:
+                if json.load(f).get('keep'):
+                    continue
+            if self.eval_path is not None and not os.path.exists(os.path.join(self.eval_path, METRICS_FILE.format(step))):
+                continue
+            ## .index, .data-*, .meta and .state.json
+            for filename in glob.glob(path + '.*'):
+                os.remove(filename)
+
+    def wait(self):
+        """Block until the checkpoint being written is on disk."""
+        self.pending.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, epoch, batch):
+        """Checkpoint the model, resuming starts at batch `batch` of epoch `epoch`."""
+        ## the snapshot variables are free again only once the previous save is written
+        self.wait()
+        global_step = self.model.sess.run([self.snapshot_op, self.model.global_step])[1]
+        np_state = np.random.get_state()
+        py_state = random.getstate()
+        keep = time.time() - self.kept_time >= self.keep_every_hours * 3600
+        if keep:
+            self.kept_time = time.time()
+        state = {'global_step': int(global_step),
+                 'epoch': epoch,
+                 'batch': batch,
+                 'keep': keep,
+                 'numpy_rng': [np_state[0], np_state[1].tolist()] + [float(v) for v in np_state[2:]],
+                 'python_rng': [py_state[0], list(py_state[1]), py_state[2]]}
+        self.pending.put((os.path.join(self.checkpoint_dir, CKPT_FILE.format(global_step)), state))
+
+    def restore(self):
+        """Load the newest checkpoint and return its state, or None if there is none."""
+        ckpt = tf.train.get_checkpoint_state(self.checkpoint_dir)
+        if ckpt is None or not ckpt.model_checkpoint_path:
+            return None
+        self.saver.restore(self.model.sess, ckpt.model_checkpoint_path)
+        self.model.sess.run(self.restore_op)
+
+        state_path = ckpt.model_checkpoint_path + '.state.json'
+        if not os.path.exists(state_path):
+            ## written by saveModel, the loader starts over at epoch 0
+            return {'global_step': int(self.model.sess.run(self.model.global_step)), 'epoch': 0, 'batch': 0}
+        with open(state_path) as f:
+            state = json.load(f)
+        name, keys, pos, has_gauss, cached_gaussian = state['numpy_rng']
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), int(pos), int(has_gauss), cached_gaussian))
+        version, internal, gauss_next = state['python_rng']
+        random.setstate((version, tuple(internal), gauss_next))
+        return state
+
+    def close(self):
+        self.wait()
+        self.pending.put(None)
+        self.thread.join()
@@ -0,0 +1,167 @@
+"""
+Captioning service: keeps one restored Effective_attention_model in memory
+and captions videos over HTTP.
+
+    POST /caption   body: one video's frame features, (n_frames, FEATURE_DIM), as .npy bytes
+                    answer: {"caption": "..."}
+    GET  /health    answer: {"status": "ok", "batches": ..., "videos": ...}
+
+Requests are not predicted one by one. MicroBatcher gathers the requests that
+arrive together into one batch, of at most MAX_BATCH_SIZE videos, waiting no
+longer than MAX_LATENCY_MS after the first one, and runs a single predict
+for the whole batch.
+
+>>> curl --data-binary @video.npy http://127.0.0.1:8000/caption
+
+usage: python3 serve.py [model_path] [port]
+"""
+import io
+import sys
+import json
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import model
+import input
+import test_main
+from vocab import Vocab
+
+HOST = '127.0.0.1'
+PORT = 8000
+MODEL_PATH = './model_30000.ckpt'
+MAX_BATCH_SIZE = 32
+MAX_LATENCY_MS = 20
+## seconds a request may wait for its caption
+REQUEST_TIMEOUT = 30
+## larger bodies are refused before they are read
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+
+class MicroBatcher():
+    """
+    Coalesces single videos into batches for `predict(x_batch) -> [caption]`.
+    `submit(x)` returns a Future of the caption. One thread owns the batch
+    array and calls predict, so the model is never run concurrently.
+    """
+    def __init__(self, predict, sampler, frame_dim, max_batch_size=MAX_BATCH_SIZE, max_latency_ms=MAX_LATENCY_MS):
+        self.predict = predict
+        self.sampler = sampler
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.x = np.zeros((max_batch_size, sampler.frame_step, frame_dim), dtype=np.float32)
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.videos = 0
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, x):
+        future = Future()
+        self.requests.put((x, future))
+        return future
+
+    def _next_batch(self):
+        ## block for the first video, then take whatever arrives within the latency budget
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                for j, (x, _) in enumerate(batch):
+                    self.sampler.sample_into(x, self.x[j])
+                captions = self.predict(self.x[:len(batch)])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.videos += len(batch)
+            for (_, future), caption in zip(batch, captions):
+                future.set_result(caption)
+
+
+def make_handler(batcher, frame_dim):
+    class CaptionHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self._reply(404, {'error': 'not found'})
+            self._reply(200, {'status': 'ok', 'batches': batcher.batches, 'videos': batcher.videos})
+
+        def do_POST(self):
+            if self.path != '/caption':
+                return self._reply(404, {'error': 'not found'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.close_connection = True
+                return self._reply(400, {'error': 'invalid Content-Length'})
+            if length > MAX_BODY_BYTES:
+                ## the body is left unread, so the connection cannot be reused
+                self.close_connection = True
+                return self._reply(413, {'error': 'body larger than {0} bytes'.format(MAX_BODY_BYTES)})
+            try:
+                x = np.load(io.BytesIO(self.rfile.read(length)), allow_pickle=False)
+            except Exception as e:
+                ## empty (EOFError), corrupt header (ValueError, TokenError, ...)
+                return self._reply(400, {'error': 'body is not a .npy array: {0}: {1}'.format(type(e).__name__, e)})
+            if not isinstance(x, np.ndarray):
+                ## an .npz archive loads as an NpzFile
+                if hasattr(x, 'close'):
+                    x.close()
+                return self._reply(400, {'error': 'body is not a .npy array: got {0}'.format(type(x).__name__)})
+            if x.ndim != 2 or x.shape[0] == 0 or x.shape[1] != frame_dim:
+                return self._reply(400, {'error': 'expected (n_frames, {0}) features, got {1}'.format(frame_dim, x.shape)})
+            try:
+                caption = batcher.submit(x).result(timeout=REQUEST_TIMEOUT)
+            except Exception as e:
+                return self._reply(500, {'error': '{0}: {1}'.format(type(e).__name__, e)})
+            self._reply(200, {'caption': caption})
+
+    return CaptionHandler
+
+
+def main(model_path=MODEL_PATH, port=PORT):
+    vocab = Vocab.load(test_main.VOCAB_PATH, test_main.DICT_REV_PATH)
+    S2VT = model.Effective_attention_model(frame_feat_dim=test_main.FEATURE_DIM, caption_steps=test_main.CAPTION_STEP,
+                                           beam_width=test_main.BEAM_WIDTH, training=False)
+    S2VT.loadModel(model_path)
+
+    def predict(x):
+        if test_main.BEAM_WIDTH > 0:
+            return vocab.decode(S2VT.predict_beam(x, length_penalty=test_main.LENGTH_PENALTY)[0])
+        return vocab.decode(S2VT.predict(x)[0])
+
+    sampler = input.FrameSampler(test_main.FRAME_STEP, test_main.FRAME_SAMPLING, test_main.FRAME_STRIDE)
+    batcher = MicroBatcher(predict, sampler, test_main.FEATURE_DIM)
+    server = ThreadingHTTPServer((HOST, port), make_handler(batcher, test_main.FEATURE_DIM))
+    print('serving captions on http://{0}:{1}/caption'.format(HOST, port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else MODEL_PATH, int(sys.argv[2]) if len(sys.argv) > 2 else PORT)
@@ -6,37 +6,54 @@ import util
 import input
 import eval
 import time
+from vocab import Vocab
 
 VOCAB_SIZE = 3000
 FRAME_STEP = 20
 FRAME_DIM = 4096
 BATCH_SIZE = 100
 CAPTION_STEP = 45
+FRAME_SAMPLING = 'stride'
+FRAME_STRIDE = 4
+BEAM_WIDTH = 5
+LENGTH_PENALTY = 0.6
 EPOCH = 1000
 SCHEDULED_SAMPLING_CONVERGE = 5000
 MODEL_FILE_NAME = 'result_schedule'
+## vocab.npy if there is one, else the vocabulary is built from dict_rev.json
+VOCAB_PATH = 'vocab.npy'
+DICT_REV_PATH = 'dict_rev.json'
+## graph written by export.py, starts without building the model; None restores the checkpoint
+FROZEN_GRAPH = None
+## pack of the private features and its REDUCED_DIM-d copy, reduced with the training projection
+## (util.reduce_features(PACK_PATH, REDUCED_DIM, projection=...)); None reads the full features
+PACK_PATH = None
+REDUCED_DIM = None
+FEATURE_DIM = REDUCED_DIM or FRAME_DIM
 
 
-def trim(sen):
-    if 3 in sen:
-        return sen[:sen.index(3)]
-    else:
-        return sen
-
-def test(model, test_data, dict_rev):
-    answers = []
-    score = 0
-    for x, video_ids in test_data:
-        result = model.predict(x)
-        sentences = [' '.join([dict_rev[str(word)]
-                               for word in trim(sen.tolist())]) for sen in result[0]]
-        answers.extend(list(zip(video_ids, sentences)))
-    json.dump([{'caption': cap, 'id:': vid} for vid, cap in answers],
-              open('output.json', 'w'))
+def test(model, test_data, vocab, output_path='output.json'):
+    """
+    Predict batch by batch and stream every caption to `output_path` as
+    soon as it is decoded, the answers are never held in memory together.
+    """
+    with open(output_path, 'w') as f:
+        f.write('[')
+        separator = ''
+        for x, video_ids in test_data:
+            if BEAM_WIDTH > 0:
+                result = model.predict_beam(x, length_penalty=LENGTH_PENALTY)
+            else:
+                result = model.predict(x)
+            sentences = vocab.decode(result[0])
+            for vid, cap in zip(video_ids, sentences):
+                f.write(separator + json.dumps({'caption': cap, 'id:': vid}))
+                separator = ', '
+        f.write(']')
 
 def main():
 
-    d_idx2word = json.load(open('dict_rev.json', 'r'))
+    vocab = Vocab.load(VOCAB_PATH, DICT_REV_PATH)
 
 
     feature_path = sys.argv[2]
@@ -45,15 +62,23 @@ def main():
     test_data_loader = input.TestPrivateDataLoader(id_path=id_file,
                                         data_path=feature_path,
                                         frame_step=FRAME_STEP,
-                                        frame_dim=FRAME_DIM,
+                                        frame_dim=FEATURE_DIM,
                                         caption_step=CAPTION_STEP,
                                         vocab_size=VOCAB_SIZE,
-                                        shuffle=False
+                                        shuffle=False,
+                                        sampler=input.FrameSampler(FRAME_STEP, FRAME_SAMPLING, FRAME_STRIDE),
+                                        pack_path=PACK_PATH,
+                                        reduced_dim=REDUCED_DIM
                                         )
-    S2VT = model.Effective_attention_model(caption_steps=CAPTION_STEP)
-    S2VT.loadModel('./model_30000.ckpt')
-    test_batch = test_data_loader.get_data(BATCH_SIZE)
-    test(S2VT, test_batch, d_idx2word)
+    if FROZEN_GRAPH:
+        S2VT = model.Frozen_inference_model(FROZEN_GRAPH)
+    else:
+        S2VT = model.Effective_attention_model(frame_feat_dim=FEATURE_DIM, caption_steps=CAPTION_STEP,
+                                               beam_width=BEAM_WIDTH, training=False)
+        S2VT.loadModel('./model_30000.ckpt')
+    ## features of the next batch load while the current one is predicted
+    test_batch = test_data_loader.batch_gen(BATCH_SIZE)
+    test(S2VT, test_batch, vocab)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,43 @@
+"""
+Graph construction and one training step of the captioning models, run with
+    python3 -m pytest test_model.py
+"""
+import numpy as np
+import pytest
+tf = pytest.importorskip('tensorflow')
+import model
+
+
+def build(precision):
+    return model.Effective_attention_model(frame_steps=4, frame_feat_dim=8, caption_steps=5, vocab_size=10,
+                                           dim_hidden=6, buckets=[3], beam_width=2, precision=precision)
+
+
+@pytest.mark.parametrize('precision', ['float16', 'bfloat16'])
+def test_low_precision_builds_training_step(precision):
+    with tf.Graph().as_default():
+        S2VT = build(precision)
+        ## the optimizer got real float32 slot variables, not casts of them
+        slots = [v for v in tf.global_variables() if '/Adam' in v.op.name]
+        assert slots
+        assert all(v.dtype.base_dtype == tf.float32 for v in tf.global_variables() if v.dtype.is_floating)
+        assert all(train_op is not None for _, train_op in S2VT.bucket_ops.values())
+        ## the cast getter did not outlive the model
+        assert tf.get_variable_scope().custom_getter is None
+        S2VT.sess.close()
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float16'])
+def test_trains_and_predicts(precision):
+    rng = np.random.RandomState(0)
+    x = rng.standard_normal((2, 4, 8)).astype(np.float32)
+    ## <bos> w w <eos>, fits the bucket of 3 steps
+    y = np.array([[4, 5, 6, 3], [4, 7, 3, 0]])
+    y_mask = np.array([[1, 1, 1, 1], [1, 1, 1, 0]], dtype=np.float32)
+    with tf.Graph().as_default():
+        S2VT = build(precision)
+        S2VT.initialize()
+        assert np.isfinite(S2VT.train(x, y, y_mask))
+        assert S2VT.predict(x)[0].shape == (2, 5)
+        assert S2VT.predict_beam(x)[0].shape == (2, 5)
+        S2VT.sess.close()
@@ -3,8 +3,13 @@ import os
 import numpy as np
 import json
 import re
+import hashlib
 import random
+import time
+import contextlib
 from collections import Counter
+from vocab import Vocab
+import input
 # from tqdm import tqdm
 import logging
 import multiprocessing as mp
@@ -17,6 +22,85 @@ UNK_ID = 1
 BOS_ID = 4
 
 
+"""
+Tokenize every caption of the label files once and cache the result.
+{cache_path}/<label file>.<sha1 of its content>.npz holds
+    words          every distinct word, in order of first appearance
+    tokens         all captions back to back as indices into `words`
+    lengths        token count of every caption
+    video_ids      id of every video
+    caption_counts caption count of every video
+The indices are local to the file, so a cache stays valid when the
+dictionary changes and only a changed label file is tokenized again.
+"""
+
+def tokenize_caption(sentence):
+    sentence = re.sub(replace_char, ' ', sentence).replace(".", " <eos>")
+    words = [w.lower() for w in sentence.split()]
+
+    if not words or words[-1] != '<eos>':
+        words.append('<eos>')
+    words.insert(0, '<bos>')
+    return words
+
+
+def _tokenize_videos(videos):
+    return [[tokenize_caption(sentence) for sentence in datum['caption']] for datum in videos]
+
+
+def _label_cache_file(label_json, cache_path):
+    with open(label_json, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    return os.path.join(cache_path, '{0}.{1}.npz'.format(os.path.basename(label_json), digest))
+
+
+def tokenize_labels(label_jsons, cache_path='data/caption_cache', num_workers=4):
+    """Return the cached arrays of every file in `label_jsons`, tokenizing the missing ones in parallel."""
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    cache_files = [_label_cache_file(label_json, cache_path) for label_json in label_jsons]
+
+    pool = None
+    for label_json, cache_file in zip(label_jsons, cache_files):
+        if os.path.exists(cache_file):
+            continue
+        json_obj = json.load(open(label_json, 'r'))
+        if pool is None:
+            pool = mp.Pool(num_workers)
+        chunk = max(1, (len(json_obj) + num_workers - 1) // num_workers)
+        captions = []
+        for part in pool.map(_tokenize_videos, [json_obj[i:i+chunk] for i in range(0, len(json_obj), chunk)]):
+            captions.extend(part)
+
+        word_index = {}
+        tokens, lengths = [], []
+        for video in captions:
+            for words in video:
+                tokens.extend(word_index.setdefault(w, len(word_index)) for w in words)
+                lengths.append(len(words))
+        words = sorted(word_index, key=word_index.get)
+
+        ## write aside and rename, a killed run never leaves a truncated cache
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f,
+                     words=np.array(words, dtype=np.str_),
+                     tokens=np.array(tokens, dtype=np.int32),
+                     lengths=np.array(lengths, dtype=np.int32),
+                     video_ids=np.array([datum['id'] for datum in json_obj], dtype=np.str_),
+                     caption_counts=np.array([len(video) for video in captions], dtype=np.int32))
+        os.replace(tmp_file, cache_file)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    labels = []
+    for cache_file in cache_files:
+        with np.load(cache_file) as cache:
+            labels.append(dict((key, cache[key]) for key in cache.files))
+    return labels
+
+
 """
 Create dictionary mapping word string to word index.
 The dictionary contains only top-{VOCAB_COUNT} most common word.    
@@ -26,28 +110,16 @@ def build_word2idx_dict(vocab_size=3000,
                         trainlable_json='data/training_label.json', 
                         testlabel_json='data/testing_public_label.json',
                         dict_path='data/dict.json',
-                        dict_rev_path='data/dict_rev.json'):
-        
-    def _get_words_in_json(filepath):
-        json_obj = json.load(open(filepath, 'r'))
+                        dict_rev_path='data/dict_rev.json',
+                        vocab_path='data/vocab.npy',
+                        cache_path='data/caption_cache'):
         
-        all_words = []
-        for datum in json_obj:
-            for sentence in datum['caption']:
-                sentence = re.sub(replace_char, ' ', sentence).replace(".", " <eos>")
-                words = [w.lower() for w in sentence.split()]
-                
-                if words[-1] != '<eos>':
-                    words.append('<eos>')
-                words.insert(0, '<bos>')
-                
-                all_words.extend(words)
-    
-        return all_words
-    
-    words = _get_words_in_json(trainlable_json) + _get_words_in_json(testlabel_json)
-    
-    word_counter = Counter(words)
+    ## words are added in order of first appearance, so ties rank as before
+    word_counter = Counter()
+    for labels in tokenize_labels([trainlable_json, testlabel_json], cache_path):
+        counts = np.bincount(labels['tokens'], minlength=len(labels['words']))
+        for w, count in zip(labels['words'].tolist(), counts.tolist()):
+            word_counter[w] += count
     """
     There is 6085 words in this Counter.
     3772 words apppears at least 2 times.
@@ -66,35 +138,181 @@ def build_word2idx_dict(vocab_size=3000,
         json.dump(dictionary, f)
     with open(dict_rev_path, 'w') as f:
         json.dump(dictionary_rev, f)
+    ## id-indexed token array, decodes whole prediction batches at once
+    Vocab.fromdict(dictionary_rev).tonpy(vocab_path)
 
 
     
-def get_tr_in_idx(trainlable_json='data/training_label.json', dict_path='data/dict.json'):
+def get_tr_in_idx(trainlable_json='data/training_label.json', dict_path='data/dict.json',
+                  cache_path='data/caption_cache'):
     d_word2idx = json.load(open(dict_path, 'r'))
-    json_obj = json.load(open(trainlable_json, 'r'))
+    labels = tokenize_labels([trainlable_json], cache_path)[0]
+
+    ## map the file-local word indices to dictionary ids in one lookup
+    local2idx = np.array([d_word2idx.get(w, UNK_ID) for w in labels['words'].tolist()], dtype=np.int32)
+    captions = np.split(local2idx[labels['tokens']], np.cumsum(labels['lengths'])[:-1])
     
     new_json_obj = []
-    
-    for datum in json_obj:           
-        new_datum = {} 
-        new_datum['id'] = datum['id']
-        new_datum['caption'] = []
-
-           
-        for sentence in datum['caption']:
-            sentence = re.sub(replace_char, ' ', sentence).replace(".", " <eos>")
-            words = [w.lower() for w in sentence.split()]
-            
-            if words[-1] != '<eos>':
-                    words.append('<eos>')
-            words.insert(0, '<bos>')
-            
-            new_datum['caption'].append([d_word2idx[w] if w in d_word2idx else 1 for w in words])
-        new_json_obj.append(new_datum)
+    offset = 0
+    for video_id, count in zip(labels['video_ids'].tolist(), labels['caption_counts'].tolist()):
+        new_json_obj.append({'id': video_id,
+                             'caption': [caption.tolist() for caption in captions[offset:offset+count]]})
+        offset += count
     
     return new_json_obj   
 
 
+"""
+Pack every `<video_id>.npy` under {data_path} into one memory-mapped array.
+{pack_path}/feat.npy holds all frames back to back and {pack_path}/index.json
+maps each video id to [offset, frame_count] in it. Load it back with
+`input.FeatureStore(data_path, pack_path)`.
+"""
+
+def pack_features(data_path='data/training_data/feat',
+                  pack_path='data/training_data/pack'):
+    video_ids = sorted(f[:-len('.npy')] for f in os.listdir(data_path) if f.endswith('.npy'))
+    if not video_ids:
+        raise ValueError('no <video_id>.npy features to pack in {0}'.format(data_path))
+
+    ## first pass only reads the npy headers to size the packed array
+    index = {}
+    offset = 0
+    frame_dim, dtype = None, None
+    for video_id in video_ids:
+        feat = np.load(os.path.join(data_path, video_id + '.npy'), mmap_mode='r')
+        if frame_dim is None:
+            frame_dim, dtype = feat.shape[1], feat.dtype
+        index[video_id] = [offset, feat.shape[0]]
+        offset += feat.shape[0]
+
+    if not os.path.exists(pack_path):
+        os.makedirs(pack_path)
+    packed = np.lib.format.open_memmap(input.pack_feat_path(pack_path), mode='w+',
+                                       dtype=dtype, shape=(offset, frame_dim))
+    for video_id in video_ids:
+        start, length = index[video_id]
+        packed[start:start+length] = np.load(os.path.join(data_path, video_id + '.npy'))
+    packed.flush()
+    del packed
+
+    with open(os.path.join(pack_path, input.PACK_INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+
+"""
+Reduce the packed features of {pack_path} to {dim} dimensions, written as
+{pack_path}/feat_<dim>.npy next to feat.npy and read with
+`input.FeatureStore(data_path, pack_path, reduced_dim=dim)`.
+    pca     projects on the top {dim} principal components, fitted on
+            {num_samples} random frames
+    random  a Gaussian random projection, no fitting
+The projection is saved as {pack_path}/projection_<dim>.npz. Pass it as
+{projection} to reduce another pack (test, private) with the same one.
+"""
+
+def reduce_features(pack_path='data/training_data/pack', dim=512, method='pca', dtype='float16',
+                    projection=None, num_samples=20000, seed=0, chunk_size=4096):
+    feat = np.load(input.pack_feat_path(pack_path), mmap_mode='r')
+    rng = np.random.RandomState(seed)
+    if projection is not None:
+        with np.load(projection) as saved:
+            mean, components = saved['mean'], saved['components']
+    elif method == 'pca':
+        ## sorted rows read the memmap front to back
+        rows = np.sort(rng.choice(feat.shape[0], min(num_samples, feat.shape[0]), replace=False))
+        sample = np.asarray(feat[rows], dtype=np.float64)
+        mean = sample.mean(axis=0)
+        sample -= mean
+        ## eigenvectors of the covariance, eigh returns them in ascending order
+        _, vectors = np.linalg.eigh(sample.T.dot(sample))
+        components = vectors[:, ::-1][:, :dim]
+    elif method == 'random':
+        mean = np.zeros(feat.shape[1])
+        components = rng.standard_normal((feat.shape[1], dim)) / np.sqrt(dim)
+    else:
+        raise ValueError('unknown reduction method: {0}'.format(method))
+    mean, components = mean.astype(np.float32), components.astype(np.float32)
+    if components.shape != (feat.shape[1], dim):
+        raise ValueError('projection maps {0} to {1} dims, not {2} to {3}'.format(
+            components.shape[0], components.shape[1], feat.shape[1], dim))
+
+    reduced = np.lib.format.open_memmap(input.pack_feat_path(pack_path, dim), mode='w+',
+                                        dtype=dtype, shape=(feat.shape[0], dim))
+    for start in range(0, feat.shape[0], chunk_size):
+        chunk = np.asarray(feat[start:start+chunk_size], dtype=np.float32)
+        reduced[start:start+chunk_size] = (chunk - mean).dot(components)
+    reduced.flush()
+    del reduced
+    if projection is None:
+        np.savez(os.path.join(pack_path, input.PACK_PROJECTION_FILE.format(dim)),
+                 mean=mean, components=components, method=np.array(method))
+
+
+"""
+Wall-clock time spent in each stage of the training loop, e.g. waiting on
+the loader, in sess.run, in evaluation and in checkpointing. `summary()`
+reports the stages since the previous summary, so a loader share near 100%
+means the loop is input bound and a train share near 100% compute bound.
+
+    timer = StageTimer()
+    for batch in timer.iterate('loader', batches):
+        with timer.stage('train'):
+            model.train(*batch)
+"""
+
+class StageTimer():
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.start_time = time.time()
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start_time)
+
+    def iterate(self, name, iterable):
+        """Yield from `iterable`, timing every wait for the next item as stage `name`."""
+        iterator = iter(iterable)
+        while True:
+            start_time = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.time() - start_time)
+            yield item
+
+    def summary(self):
+        """{stage: {seconds, count, mean_ms, share}} since the last summary, then reset."""
+        wall = max(time.time() - self.start_time, 1e-9)
+        result = {'wall_seconds': wall}
+        for name, seconds in self.totals.items():
+            result[name] = {'seconds': seconds,
+                            'count': self.counts[name],
+                            'mean_ms': 1000.0 * seconds / self.counts[name],
+                            'share': seconds / wall}
+        self.totals, self.counts = {}, {}
+        self.start_time = time.time()
+        return result
+
+    @staticmethod
+    def format(summary):
+        stages = sorted(name for name in summary if name != 'wall_seconds')
+        return ' '.join('{0} {1:.1f}s ({2:.0%}, {3:.1f}ms avg)'.format(name, summary[name]['seconds'],
+                                                                      summary[name]['share'],
+                                                                      summary[name]['mean_ms'])
+                        for name in stages)
+
+
 # class Data:
 #     def __init__(self, feat_dir, training_json, word2idx, idx2word, batch_size, shuffle=True):
 #         self.feat_dir = feat_dir
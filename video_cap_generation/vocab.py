@@ -0,0 +1,81 @@
+"""
+Array-backed vocabulary for video captioning
+
+Word ids index straight into a NumPy array of tokens, so a whole
+(batch_size, caption_steps) prediction matrix is decoded with one fancy
+indexing op instead of a `dict_rev[str(word)]` lookup per word. The binary
+`.npy` format is a fixed-width unicode array and loads without JSON parsing.
+`Vocab.load('data/vocab.npy', 'data/dict_rev.json')` reads the `.npy` file
+written by `util.build_word2idx_dict`, or builds the vocabulary from
+dict_rev.json where only that one exists.
+
+>>> import numpy as np
+>>> from vocab import Vocab
+>>> vocab = Vocab.fromdict({'2': 'a', '3': '<eos>', '4': '<bos>', '5': 'man', '6': 'woman', '7': 'is'})
+>>> vocab.decode(np.array([[2, 5, 3, 3], [2, 6, 7, 3]]))
+['a man', 'a woman is']
+>>> vocab.encode(['a', 'dog'])
+[2, 1]
+
+"""
+import os
+import json
+import numpy as np
+
+PAD_ID = 0
+UNK_ID = 1
+EOS_ID = 3
+
+
+class Vocab():
+    def __init__(self, tokens):
+        ## (vocab_size,) unicode array, tokens[i] is the word of id i
+        self.tokens = np.asarray(tokens, dtype=np.str_)
+        self.word2idx = dict((w, i) for i, w in enumerate(self.tokens.tolist()))
+
+    @classmethod
+    def fromdict(cls, dict_rev):
+        """From an id -> word mapping such as dict_rev.json (keys may be strings)"""
+        dict_rev = dict((int(k), v) for k, v in dict_rev.items())
+        tokens = [''] * (max(dict_rev) + 1)
+        tokens[PAD_ID] = '<pad>'
+        tokens[UNK_ID] = '<unk>'
+        for i, w in dict_rev.items():
+            tokens[i] = w
+        return cls(tokens)
+
+    @classmethod
+    def fromjson(cls, path):
+        with open(path) as f:
+            return cls.fromdict(json.load(f))
+
+    @classmethod
+    def fromnpy(cls, path):
+        return cls(np.load(path))
+
+    @classmethod
+    def load(cls, npy_path, json_path):
+        """From `npy_path` if it exists, else from the dict_rev.json at `json_path`"""
+        if os.path.exists(npy_path):
+            return cls.fromnpy(npy_path)
+        return cls.fromjson(json_path)
+
+    def tonpy(self, path):
+        np.save(path, self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def encode(self, words):
+        return [self.word2idx.get(w, UNK_ID) for w in words]
+
+    def decode(self, ids, eos_id=EOS_ID):
+        """
+        Decode a (batch_size, steps) id matrix into one sentence per row,
+        each cut before its first <eos>.
+        """
+        ids = np.asarray(ids)
+        words = self.tokens[ids]
+        is_eos = ids == eos_id
+        lengths = np.where(is_eos.any(axis=1), is_eos.argmax(axis=1), ids.shape[1])
+        return [' '.join(row[:length]) for row, length in zip(words.tolist(), lengths)]